@@ -11,49 +11,241 @@ from __future__ import absolute_import
 import os
 import re
 import sys
-import lxml.etree
+import mmap
+import warnings
 
 from . import job, main, utils
 
 
 #-----------------------------------------------------------------------------
-def git_refs_iter_local(repo):
+def git_refs_iter_local(repo, prefixes=None):
+    gitdir, commondir = find_git_dirs(repo)
+
+    # Repositories that use the reftable backend are read by git itself.
+    if gitdir is None or os.path.isdir(os.path.join(commondir, 'reftable')):
+        return git_refs_iter_show_ref(repo, prefixes)
+
+    refs = read_refs(gitdir, commondir, prefixes)
+    return iter(sorted(refs.items()))
+
+def git_refs_iter_show_ref(repo, prefixes=None):
     cmd = ('git', 'show-ref')
-    out = utils.check_output(cmd, cwd=repo).split('\n')
+    for line in utils.iter_output(cmd, cwd=repo):
+        sha, ref = line.split()
+        if prefixes and not ref.startswith(prefixes):
+            continue
+        yield ref, sha
+
+def find_git_dirs(repo):
+    '''
+    Return the git directory of a repository (or worktree) and the common
+    directory that holds its refs. The git directory is either the .git
+    directory, the directory that a .git file points to or the repository
+    itself (if it is bare).
+    '''
+
+    gitdir = os.path.join(repo, '.git')
+    if os.path.isfile(gitdir):
+        with open(gitdir) as fh:
+            line = fh.readline().strip()
+        if not line.startswith('gitdir:'):
+            return None, None
+        gitdir = os.path.join(repo, line[len('gitdir:'):].strip())
+    elif not os.path.isdir(gitdir):
+        gitdir = repo
+
+    if not os.path.isfile(os.path.join(gitdir, 'HEAD')):
+        return None, None
+
+    commondir = gitdir
+    path = os.path.join(gitdir, 'commondir')
+    if os.path.isfile(path):
+        with open(path) as fh:
+            commondir = os.path.join(gitdir, fh.read().strip())
+
+    return os.path.normpath(gitdir), os.path.normpath(commondir)
+
+packed_ref_re = re.compile(r'^([0-9a-f]{40,64}) ([^\n]+)$', re.M)
+
+def read_packed_refs(path):
+    '''Read a packed-refs file into a {ref: sha} dict.'''
+
+    try:
+        fh = open(path, 'rb')
+    except (IOError, OSError):
+        return {}
+
+    with fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return {}
+
+        packed = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            text = packed[:].decode('utf8')
+        finally:
+            packed.close()
+
+    # The header and the peeled values of annotated tags (lines starting
+    # with '#' and '^') are skipped by the pattern.
+    return dict((ref, sha) for sha, ref in packed_ref_re.findall(text))
+
+def read_loose_ref(path):
+    '''Return the contents of a loose ref file - a sha or a "ref: <name>" symref.'''
+    try:
+        with open(path, 'rb') as fh:
+            return fh.read().strip().decode('utf8')
+    except (IOError, OSError):
+        return None
+
+is_sha = re.compile('[0-9a-f]{40}([0-9a-f]{24})?$')
+
+def read_refs(gitdir, commondir, prefixes=None):
+    '''
+    Read all refs of a repository into a {ref: sha} dict without running
+    git. Loose refs take precedence over packed refs and symbolic refs are
+    resolved to the sha of the ref they point to. If prefixes are given,
+    only refs that start with one of them are returned.
+    '''
+
+    packed = read_packed_refs(os.path.join(commondir, 'packed-refs'))
+
+    # Only the directories that can contain matching refs are searched.
+    if prefixes:
+        top = set(prefix.rsplit('/', 1)[0] for prefix in prefixes)
+    else:
+        top = ['refs']
+
+    # Per-worktree refs (refs/bisect etc) are kept in the git directory.
+    basedirs = [commondir] if gitdir == commondir else [commondir, gitdir]
+
+    loose = {}
+    for basedir in basedirs:
+        for refdir in top:
+            for root, dirs, files in os.walk(os.path.join(basedir, refdir)):
+                for name in files:
+                    if name.endswith('.lock'):
+                        continue
+                    path = os.path.join(root, name)
+                    value = read_loose_ref(path)
+                    if value:
+                        loose[os.path.relpath(path, basedir).replace(os.sep, '/')] = value
+
+    def resolve(value, depth=0):
+        while value and value.startswith('ref:') and depth < 5:
+            target = value[4:].strip()
+            value = loose.get(target) or packed.get(target) \
+                    or read_loose_ref(os.path.join(commondir, target))
+            depth += 1
+        return value if value and is_sha.match(value) else None
+
+    if prefixes:
+        res = dict(i for i in packed.items() if i[0].startswith(prefixes))
+    else:
+        res = packed
+
+    for ref, value in loose.items():
+        if prefixes and not ref.startswith(prefixes):
+            continue
+        sha = resolve(value)
+        if sha:
+            res[ref] = sha
+        else:
+            res.pop(ref, None)
+
+    return res
 
-    return (ref for sha, ref in [i.split() for i in out if i])
+def git_refs_iter_dated(repo, prefixes=None):
+    '''List the refs of a local repository as (ref, sha, timestamp) tuples.
+       The timestamp is the committer date of commits and the tagger date
+       of annotated tags.'''
 
-def git_refs_iter_remote(repo):
-    cmd = ('git', 'ls-remote', repo)
-    out = utils.check_output(cmd).decode('utf8').split('\n')
+    cmd = ['git', 'for-each-ref', '--format=%(objectname) %(creatordate:unix) %(refname)']
 
-    for sha, ref in (i.split() for i in out if i):
+    # Patterns match whole path components.
+    if prefixes:
+        cmd.extend(sorted(set(prefix.rsplit('/', 1)[0] for prefix in prefixes)))
+
+    for line in utils.iter_output(cmd, cwd=repo):
+        sha, date, ref = line.split(' ', 2)
+        if prefixes and not ref.startswith(prefixes):
+            continue
+        yield ref, sha, int(date) if date else None
+
+def git_refs_iter_remote(repo, prefixes=None):
+    cmd = ['git', 'ls-remote']
+
+    # Ask the server for just the refs that start with one of the prefixes.
+    # With protocol v2, --heads and --tags are sent to the server as ref
+    # prefixes. Patterns only help with older protocols, as they are
+    # matched on the client.
+    if prefixes:
+        kinds = [i for i in ('heads', 'tags') if any(p.startswith('refs/%s/' % i) for p in prefixes)]
+        if all(p.startswith(('refs/heads/', 'refs/tags/')) for p in prefixes):
+            cmd.extend('--' + i for i in kinds)
+        cmd.append(repo)
+        cmd.extend(get_ls_remote_pattern(i) for i in prefixes)
+    else:
+        cmd.append(repo)
+
+    for line in utils.iter_output(cmd):
+        sha, ref = line.split()
         if not ref.startswith('refs/'):
             continue
         # :todo: generalize
         if ref.endswith('^{}'):
             continue
+        # Patterns match the end of refs, so they let some other refs through.
+        if prefixes and not ref.startswith(prefixes):
+            continue
+
+        yield ref, sha
+
+def get_ls_remote_pattern(prefix):
+    '''
+    Glob pattern that matches all refs that start with prefix.
+
+    >>> get_ls_remote_pattern('refs/heads/release-[1]')
+    'refs/heads/release-\\\\[1]*'
+    '''
+    return re.sub(r'([\\*?\[])', r'\\\1', prefix) + '*'
+
+def get_ref_prefixes(config):
+    '''
+    Return the literal prefixes that all refs matched by the config's ref
+    regexes start with, or None if they can match any ref.
+    '''
+    prefixes = sorted(set(utils.literal_prefix(regex.pattern) for regex in config['refs']))
+    if not prefixes or not all(p.startswith('refs/') for p in prefixes):
+        return None
 
-        yield ref
+    # Drop the prefixes that start with another prefix.
+    res = []
+    for prefix in prefixes:
+        if not res or not prefix.startswith(res[-1]):
+            res.append(prefix)
+    return tuple(res)
 
 def list_branches(config):
+    '''List all refs as (ref, sha) pairs. If 'max-age' is set, the refs of
+       local repositories are listed with their commit time as well.'''
+
     # should ls-remote or git show-ref be used
     islocal = os.path.isdir(config['repo'])
     refs_iter = git_refs_iter_local if islocal else git_refs_iter_remote
 
-    return refs_iter(config['repo'])
+    if config.get('max-age') is not None:
+        if islocal:
+            refs_iter = git_refs_iter_dated
+        else:
+            msg = 'The max-age option is not supported for remote repositories.'
+            warnings.warn(msg)
 
-def create_job(ref, template, config, ref_config):
-    '''Create a jenkins job.
+    return refs_iter(config['repo'], get_ref_prefixes(config))
 
-       :param ref:         git ref name (ex: refs/heads/something)
-       :param template:    the config of the template job to use
-       :param config:      global config (parsed yaml)
-       :param ref_config:  the effective config for this ref
-       :returns:           the name of the newly created job
-    '''
+def get_fmtdict(ref, config, ref_config):
+    '''Return the placeholders available to the 'substitute' and 'namefmt'
+       options as (groups, groupdict, fmtdict).'''
 
-    print('\nprocessing ref: %s' % ref)
     shortref = re.sub('^refs/(heads|tags|remotes)/', '', ref)
 
     sanitized_ref = utils.sanitize(ref, ref_config['sanitize'])
@@ -66,7 +258,6 @@ def create_job(ref, template, config, ref_config):
     match = ref_config['re'].match(ref)
     groups, groupdict = match.groups(), match.groupdict()
 
-    # Placeholders available to the 'substitute' and 'namefmt' options.
     fmtdict = {
         'ref':      sanitized_ref,
         'shortref': sanitized_shortref,
@@ -76,8 +267,31 @@ def create_job(ref, template, config, ref_config):
         'shortref-orig': shortref,
     }
 
+    return groups, groupdict, fmtdict
+
+def get_job_name(ref, config, ref_config):
+    '''Return the name of the job for a ref.'''
+    groups, groupdict, fmtdict = get_fmtdict(ref, config, ref_config)
+    return ref_config['namefmt'].format(*groups, **utils.merge(groupdict, fmtdict))
+
+def create_job(ref, template, config, ref_config):
+    '''Create a jenkins job.
+
+       :param ref:         git ref name (ex: refs/heads/something)
+       :param template:    the template job to use (job.Template)
+       :param config:      global config (parsed yaml)
+       :param ref_config:  the effective config for this ref
+       :returns:           the name of the newly created job
+    '''
+
+    print('\nprocessing ref: %s' % ref)
+
+    # Placeholders available to the 'substitute' and 'namefmt' options.
+    groups, groupdict, fmtdict = get_fmtdict(ref, config, ref_config)
+    shortref = fmtdict['shortref-orig']
+
     job_name = ref_config['namefmt'].format(*groups, **utils.merge(groupdict, fmtdict))
-    job_obj  = job.Job(job_name, ref, template, main.jenkins)
+    job_obj  = job.Job(job_name, ref, template, main.jenkins, main.inventory)
 
     fmtdict['job_name'] = job_name
 
@@ -85,26 +299,23 @@ def create_job(ref, template, config, ref_config):
     print('. job exists: %s' % job_obj.exists)
 
     try:
-        scm_el = job_obj.xml.xpath('scm[@class="hudson.plugins.git.GitSCM"]')[0]
+        scm_el = template.xpath('scm[@class="hudson.plugins.git.GitSCM"]')[0]
     except IndexError:
         msg = 'Template job %s is not configured to use Git as an SCM'
-        raise RuntimeError(msg % template)  # :bug:
+        raise RuntimeError(msg % template.name)
 
     # Get remote name.
-    remote = scm_el.xpath('//hudson.plugins.git.UserRemoteConfig/name')
+    remote = template.xpath('//hudson.plugins.git.UserRemoteConfig/name')
     remote = remote[0].text if remote else 'origin'
 
     # Set branch.
-    el = scm_el.xpath('//hudson.plugins.git.BranchSpec/name')[0]
+    el = template.xpath('//hudson.plugins.git.BranchSpec/name')[0]
     # :todo: jenkins is being very capricious about the branch-spec
-    # el.text = '%s/%s' % (remote, shortref)  # :todo:
-    el.text = shortref
+    # job_obj.set_text(el, '%s/%s' % (remote, shortref))  # :todo:
+    job_obj.set_text(el, shortref)
 
     # Set the branch that the git plugin will locally checkout to.
-    el = scm_el.xpath('//localBranch')
-    el = lxml.etree.SubElement(scm_el, 'localBranch') if not el else el[0]
-
-    el.text = shortref  # the original shortref (with '/')
+    job_obj.set_or_create_text('//localBranch', scm_el, shortref)  # the original shortref (with '/')
 
     # Set the state of the newly created job.
     job_obj.set_state(ref_config['enable'])
@@ -127,7 +338,8 @@ def create_job(ref, template, config, ref_config):
     return job_name
 
 def _main(argv=sys.argv, config=None):
-    main.main(argv[1:], config=config, create_job=create_job, list_branches=list_branches)
+    main.main(argv[1:], config=config, create_job=create_job, list_branches=list_branches,
+              get_job_name=get_job_name)
 
 if __name__ == '__main__':
     _main()
@@ -9,14 +9,32 @@ Documentation: https://github.com/gvalkov/jenkins-autojobs/
 from __future__ import absolute_import
 
 import os
-import re
 import sys
-import ast
+import glob
+import json
+import struct
+import binascii
 import warnings
+import threading
+import subprocess
 
 from . import job, main, utils
 
 
+#-----------------------------------------------------------------------------
+# Compatibility imports.
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+
+#-----------------------------------------------------------------------------
 # We do this to decouple the current interpreter version from the
 # mercurial interpreter version. The mercurial helper script is called
 # with the python version specified in the config file.
@@ -25,42 +43,232 @@ hg_remote_helper_path = os.path.join(
     'hg_remote_helper.py'
 )
 
+class HgHelper(object):
+    '''
+    A long-lived hg_remote_helper.py process that lists the branches of
+    remote repositories. The process (and the peers that it opened) is kept
+    for as long as jenkins-autojobs runs, so that mercurial is imported only
+    once for all repositories and polls. Requests are sent one at a time.
+    '''
+
+    def __init__(self, python):
+        self.cmd = [python, hg_remote_helper_path]
+        self.lock = threading.Lock()
+        self.process = None
+
+    def query(self, repo):
+        request = json.dumps({'repo': repo}) + '\n'
+
+        with self.lock:
+            if self.process is None or self.process.poll() is not None:
+                self.process = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+            try:
+                self.process.stdin.write(request.encode('utf8'))
+                self.process.stdin.flush()
+                line = self.process.stdout.readline()
+            except (IOError, OSError):
+                line = b''
+
+            if not line:
+                retcode = self.process.wait()
+                self.process = None
+                raise subprocess.CalledProcessError(retcode or 1, self.cmd)
+
+        response = json.loads(line.decode('utf8'))
+        if 'error' in response:
+            raise subprocess.CalledProcessError(1, self.cmd, response['error'])
+        return [tuple(i) for i in response['branches']]
+
+def get_helper(python):
+    with helpers_lock:
+        if python not in helpers:
+            helpers[python] = HgHelper(python)
+        return helpers[python]
+
+helpers = {}
+helpers_lock = threading.Lock()
+
+def is_current_python(python):
+    '''Check if python is unset or is the interpreter that we are running in.'''
+
+    if not python:
+        return True
+    path = which(python) or python
+    return os.path.realpath(path) == os.path.realpath(sys.executable)
+
+def get_inprocess_helper(python):
+    '''Return the helper module if the configured python is the current
+       interpreter and mercurial can be imported by it, or None.'''
+
+    global inprocess_helper
+    if not is_current_python(python):
+        return None
+    if inprocess_helper is None:
+        try:
+            from . import hg_remote_helper
+            inprocess_helper = hg_remote_helper
+        except ImportError:
+            inprocess_helper = False
+    return inprocess_helper or None
+
+inprocess_helper = None
+
 def hg_branch_iter_remote(repo, python, include_closed=True):
     if not include_closed:
         msg = 'Closed branches cannot be excluded when listing remote repositories.'
         warnings.warn(msg)
-    cmd = [python, hg_remote_helper_path, '-r', repo]
-    out = utils.check_output(cmd)
-    out = ast.literal_eval(out.decode('utf8'))
-    return [i[0] for i in out]
 
-def hg_branch_iter_local(repo, python=None, include_closed=True):
-    cmd = ['hg', '-y', 'branches', '-R', repo]
-    if include_closed:
-        cmd.append('-c')
-    out = utils.check_output(cmd).decode('utf8').split(os.linesep)
+    helper = get_inprocess_helper(python)
+    python = python or 'python'
+    if helper is None:
+        return get_helper(python).query(repo)
+
+    try:
+        return helper.list_branches(repo)
+    except Exception as error:
+        cmd = [python, hg_remote_helper_path]
+        raise subprocess.CalledProcessError(1, cmd, str(error))
+
+def hg_branch_iter_local(repo):
+    '''List the branches of a local repository as (name, head node, closed)
+       tuples. The branch cache is used if it is up to date.'''
+
+    branches = read_branch_cache(os.path.join(repo, '.hg'))
+    if branches is None:
+        branches = hg_branches_json(repo)
+    return branches
+
+def hg_branches_json(repo):
+    '''List the branches of a local repository as (name, head node, closed)
+       tuples, with one line of JSON per branch.'''
+
+    template = '{dict(branch, node, closed)|json}\\n'
+    cmd = ['hg', '-y', 'branches', '--closed', '-T', template, '-R', repo]
+    for line in utils.iter_output(cmd):
+        i = json.loads(line)
+        yield i['branch'], i['node'][:12], i['closed']
+
+def hg_branches_dated(repo):
+    '''List the branches of a local repository as (name, head node, closed,
+       timestamp) tuples, with one line of JSON per branch.'''
+
+    template = '{dict(branch, node, closed, date)|json}\\n'
+    cmd = ['hg', '-y', 'branches', '--closed', '-T', template, '-R', repo]
+    for line in utils.iter_output(cmd):
+        i = json.loads(line)
+        yield i['branch'], i['node'][:12], i['closed'], int(i['date'][0])
+
+def read_changelog_tip(path):
+    '''
+    Return the (node, rev) of the last revision in a revlog index, such as
+    00changelog.i, or None if the index is empty or in an unknown format.
+    Index entries are 64 bytes long and the node is at offset 32. Inline
+    revlogs store the data of every revision right after its entry.
+    '''
+
+    try:
+        fh = open(path, 'rb')
+    except (IOError, OSError):
+        return None
+
+    with fh:
+        data = fh.read(4)
+        if len(data) < 4:
+            return None
+
+        header = struct.unpack('>I', data)[0]
+        if header & 0xffff != 1:
+            return None
 
-    out = (re.split('\s+', i, 1) for i in out if i)
-    return (name for name, rev in out)
+        if header & (1 << 16):
+            data += fh.read()
+            offset, rev, node = 0, -1, None
+            while offset + 64 <= len(data):
+                length = struct.unpack('>i', data[offset + 8:offset + 12])[0]
+                node = data[offset + 32:offset + 52]
+                offset += 64 + length
+                rev += 1
+            if offset != len(data):
+                return None
+        else:
+            size = os.fstat(fh.fileno()).st_size
+            if size % 64:
+                return None
+            rev = size // 64 - 1
+            fh.seek(size - 64 + 32)
+            node = fh.read(20)
+
+    return binascii.hexlify(node).decode('ascii'), rev
+
+def read_branch_cache(hgdir):
+    '''
+    Read the branches of a repository from its branch cache (.hg/cache/branch2-*)
+    as (name, head node, closed) tuples. Returns None if there is no cache
+    that covers all revisions up to the current tip.
+
+    A cache file starts with a '<tip node> <tip rev> [<filtered hash>]' line
+    that is followed by one '<node> <o|c> <branch>' line for every head. The
+    filtered hash is only present if some revisions were left out.
+    '''
+
+    if os.path.exists(os.path.join(hgdir, 'sharedpath')):
+        return None
+
+    store = os.path.join(hgdir, 'store')
+    changelog = os.path.join(store if os.path.isdir(store) else hgdir, '00changelog.i')
+    tip = read_changelog_tip(changelog)
+    if tip is None:
+        return None
+
+    paths = glob.glob(os.path.join(hgdir, 'cache', 'branch2-*'))
+    for path in sorted(paths, key=lambda i: not i.endswith(('-visible', '-served'))):
+        with open(path, 'rb') as fh:
+            header = fh.readline().split()
+            if len(header) != 2 or (header[0].decode('ascii'), int(header[1])) != tip:
+                continue
+
+            heads = OrderedDict()
+            for line in fh:
+                node, state, name = line.rstrip(b'\n').split(b' ', 2)
+                heads.setdefault(name.decode('utf8'), []).append((node.decode('ascii'), state == b'c'))
+
+        # The head of a branch is its last open head (or its last head if
+        # all of them are closed). Heads are ordered by revision.
+        branches = []
+        for name, nodes in heads.items():
+            opened = [node for node, closed in nodes if not closed]
+            node = opened[-1] if opened else nodes[-1][0]
+            branches.append((name, node[:12], not opened))
+        return branches
+
+    return None
 
 def list_branches(config):
-    # Should 'hg branches' or peer.branchmap be used.
-    islocal = os.path.isdir(config['repo'])
-    branch_iter = hg_branch_iter_local if islocal else hg_branch_iter_remote
-    python = config.get('python', 'python')
+    '''List all branches as (branch, head node) pairs.'''
+
+    repo = config['repo']
+    python = config.get('python')
     include_closed = config.get('list-closed', True)
 
-    return branch_iter(config['repo'], python, include_closed)
+    # Should the branch cache (or 'hg branches') or peer.branchmap be used.
+    if not os.path.isdir(repo):
+        if config.get('max-age') is not None:
+            msg = 'The max-age option is not supported for remote repositories.'
+            warnings.warn(msg)
+        return hg_branch_iter_remote(repo, python, include_closed)
 
-def create_job(ref, template, config, ref_config):
-    '''Create a jenkins job.
-       :param ref: hg branch name
-       :param template: the config of the template job to use
-       :param config: global config (parsed yaml)
-       :param ref_config: the effective config for this branch
-    '''
+    # The dates of the branch heads are not in the branch cache.
+    if config.get('max-age') is not None:
+        branches = hg_branches_dated(repo)
+        return [(name, node, date) for name, node, closed, date in branches if include_closed or not closed]
 
-    print('\nprocessing branch: %s' % ref)
+    branches = hg_branch_iter_local(repo)
+    return [(name, node) for name, node, closed in branches if include_closed or not closed]
+
+def get_fmtdict(ref, config, ref_config):
+    '''Return the placeholders available to the 'substitute' and 'namefmt'
+       options as (groups, groupdict, fmtdict).'''
 
     sanitized_ref = utils.sanitize(ref, ref_config['sanitize'])
     sanitized_ref = sanitized_ref.replace('/', ref_config['namesep'])
@@ -68,7 +276,6 @@ def create_job(ref, template, config, ref_config):
     match = ref_config['re'].match(ref)
     groups, groupdict = match.groups(), match.groupdict()
 
-    # Placeholders available to the 'substitute' and 'namefmt' options.
     fmtdict = {
         'repo':   utils.sanitize(config['repo'], ref_config['sanitize']),
         'branch': sanitized_ref,
@@ -76,8 +283,28 @@ def create_job(ref, template, config, ref_config):
         'branch-orig': ref,
     }
 
+    return groups, groupdict, fmtdict
+
+def get_job_name(ref, config, ref_config):
+    '''Return the name of the job for a branch.'''
+    groups, groupdict, fmtdict = get_fmtdict(ref, config, ref_config)
+    return ref_config['namefmt'].format(*groups, **utils.merge(groupdict, fmtdict))
+
+def create_job(ref, template, config, ref_config):
+    '''Create a jenkins job.
+       :param ref: hg branch name
+       :param template: the template job to use (job.Template)
+       :param config: global config (parsed yaml)
+       :param ref_config: the effective config for this branch
+    '''
+
+    print('\nprocessing branch: %s' % ref)
+
+    # Placeholders available to the 'substitute' and 'namefmt' options.
+    groups, groupdict, fmtdict = get_fmtdict(ref, config, ref_config)
+
     job_name = ref_config['namefmt'].format(*groups, **utils.merge(groupdict, fmtdict))
-    job_obj = job.Job(job_name, ref, template, main.jenkins)
+    job_obj = job.Job(job_name, ref, template, main.jenkins, main.inventory)
 
     fmtdict['job_name'] = job_name
 
@@ -85,19 +312,19 @@ def create_job(ref, template, config, ref_config):
     print('. job exists: %s' % job_obj.exists)
 
     try:
-        scm_el = job_obj.xml.xpath('scm[@class="hudson.plugins.mercurial.MercurialSCM"]')[0]
+        template.xpath('scm[@class="hudson.plugins.mercurial.MercurialSCM"]')[0]
     except IndexError:
         msg = 'Template job %s is not configured to use Mercurial as an SCM'
-        raise RuntimeError(msg % template)  # :bug:
+        raise RuntimeError(msg % template.name)
 
     # Set branch.
-    el = scm_el.xpath('//branch')
+    el = template.xpath('//branch')
 
     # Newer version of the jenkins hg plugin store the branch in the
     # 'revision' element.
     if not el:
-        el = scm_el.xpath('//revision')
-    el[0].text = ref
+        el = template.xpath('//revision')
+    job_obj.set_text(el[0], ref)
 
     # Set the state of the newly created job.
     job_obj.set_state(ref_config['enable'])
@@ -119,7 +346,8 @@ def create_job(ref, template, config, ref_config):
     return job_name
 
 def _main(argv=sys.argv, config=None):
-    main.main(argv[1:], config=config, create_job=create_job, list_branches=list_branches)
+    main.main(argv[1:], config=config, create_job=create_job, list_branches=list_branches,
+              get_job_name=get_job_name)
 
 if __name__ == '__main__':
     _main()
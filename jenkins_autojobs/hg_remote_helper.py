@@ -1,23 +1,73 @@
 #!/usr/bin/env python
 # -*- coding: utf-8; -*-
 
+'''
+List the branches of remote mercurial repositories. This is imported by
+jenkins-autojobs if mercurial is installed for the same interpreter and is
+otherwise run with the python specified in the config file.
+
+When run, requests are read from stdin as lines of JSON and every request
+is answered with a line of JSON on stdout:
+
+  {"repo": "https://hg.example.org/repo"}
+  {"branches": [["default", "1d3f8c4a9b2e"], ...]}  or  {"error": "..."}
+
+Peers are kept open between requests.
+'''
+
 from __future__ import print_function
 
+import os
 import sys
-import getopt
+import json
+import threading
 
 from mercurial import ui, hg, node
 
 
-opts, args = getopt.getopt(sys.argv[1:], 'r:m:')
-opts = dict(opts)
-repo = opts['-r']
+# Peers are not thread-safe, so every thread keeps its own.
+local = threading.local()
+
+def to_bytes(value):
+    return value if isinstance(value, bytes) else value.encode('utf8')
+
+def to_str(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+def list_branches(repo):
+    '''List the branches of a repository as (name, short node) pairs.'''
+
+    peers = local.__dict__.setdefault('peers', {})
+
+    # A peer that was opened for an earlier request may have gone stale.
+    for reuse in (repo in peers, False):
+        if not reuse:
+            peers[repo] = hg.peer(ui.ui(), {}, to_bytes(repo))
+        try:
+            branchmap = peers[repo].branchmap()
+            break
+        except Exception:
+            del peers[repo]
+            if not reuse:
+                raise
+
+    return sorted((to_str(name), to_str(node.short(heads[0])))
+                  for name, heads in branchmap.items())
+
+def answer(request):
+    try:
+        return {'branches': list_branches(request['repo'])}
+    except Exception as error:
+        return {'error': '%s' % to_str(str(error))}
 
-branches = []
-peer = hg.peer(ui.ui(), {}, repo)
+def serve():
+    # Anything that mercurial prints would garble the responses.
+    out = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
 
-for name, rev in peer.branchmap().items():
-    branches.append((name, node.short(rev[0])))
+    for line in iter(sys.stdin.readline, ''):
+        print(json.dumps(answer(json.loads(line))), file=out)
+        out.flush()
 
-# This can be read back with ast.literal_eval().
-print(repr(branches))
+if __name__ == '__main__':
+    serve()
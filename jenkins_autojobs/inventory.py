@@ -0,0 +1,105 @@
+# -*- coding: utf-8; -*-
+
+from __future__ import absolute_import
+
+import threading
+
+
+class Inventory(object):
+    '''
+    A snapshot of the jobs and views on a Jenkins server. The snapshot is
+    fetched with a single request and answers existence questions from
+    memory. The jobs in a view are loaded once, when first needed. All of
+    this is kept up to date as jobs are created, removed and added to views.
+
+    A partial inventory (full=False) does not fetch the snapshot. Instead,
+    it looks up and remembers every job and view it is asked about, which
+    is cheaper when only a few jobs are of interest.
+    '''
+
+    tree = 'jobs[name],views[name]'
+
+    def __init__(self, jenkins, full=True):
+        self.jenkins = jenkins
+        self.full = full
+        self.lock = threading.Lock()
+        self.jobs = set()
+        self.views = set()
+        self.missing = set()
+        self.view_members = {}
+        self.view_pending = {}
+        self.refresh()
+
+    def refresh(self):
+        if not self.full:
+            with self.lock:
+                self.jobs, self.views, self.missing = set(), set(), set()
+                self.view_members = {}
+            return
+
+        res = self.jenkins.server.json('api/json?tree=%s' % self.tree,
+                                       'unable to retrieve job inventory')
+
+        with self.lock:
+            self.jobs = set(i['name'] for i in res.get('jobs', ()))
+            self.views = set(i['name'] for i in res.get('views', ()))
+            self.view_members = {}
+
+    def lookup(self, kind, names, name):
+        if self.full or name in names or (kind, name) in self.missing:
+            return name in names
+
+        obj = self.jenkins.job(name) if kind == 'job' else self.jenkins.view(name)
+        exists = obj.exists
+        with self.lock:
+            if exists:
+                names.add(name)
+            else:
+                self.missing.add((kind, name))
+        return exists
+
+    def job_exists(self, name):
+        return self.lookup('job', self.jobs, name)
+
+    def view_exists(self, name):
+        return self.lookup('view', self.views, name)
+
+    def add_job(self, name):
+        with self.lock:
+            self.jobs.add(name)
+            self.missing.discard(('job', name))
+
+    def remove_job(self, name):
+        with self.lock:
+            self.jobs.discard(name)
+            self.missing.add(('job', name))
+            for members in self.view_members.values():
+                members.discard(name)
+
+    def view_jobs(self, name):
+        '''Return the names of the jobs that were explicitly added to a view.'''
+        with self.lock:
+            members = self.view_members.get(name)
+        if members is None:
+            config = self.jenkins.view(name).config_etree
+            members = set(config.xpath('jobNames/string/text()'))
+            with self.lock:
+                members = self.view_members.setdefault(name, members)
+        return members
+
+    def view_has_job(self, name, job_name):
+        return job_name in self.view_jobs(name)
+
+    def view_add_job(self, name, job_name, pending=False):
+        '''Record that a job was added to a view. Pending additions are
+           collected until they are taken with pop_pending_views().'''
+        members = self.view_jobs(name)
+        with self.lock:
+            members.add(job_name)
+            if pending:
+                self.view_pending.setdefault(name, []).append(job_name)
+
+    def pop_pending_views(self):
+        with self.lock:
+            pending, self.view_pending = self.view_pending, {}
+        return pending
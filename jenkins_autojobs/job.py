@@ -2,26 +2,162 @@
 
 from __future__ import absolute_import
 
+import re
 import copy
+import hashlib
+import threading
 import lxml.etree
 
 from xml.sax.saxutils import escape as xmlescape
 from . import utils
 
 
+#-----------------------------------------------------------------------------
+# Compiled xpath expressions, shared by all templates.
+_xpath_cache = {}
+
+def compile_xpath(path):
+    try:
+        return _xpath_cache[path]
+    except KeyError:
+        return _xpath_cache.setdefault(path, lxml.etree.XPath(path))
+
+
+class Template(object):
+    '''
+    The config.xml of a template job, compiled into a render plan.
+
+    The elements that jobs change (the branch, state and description elements
+    and the text nodes that contain substitution keys) are located once. A
+    job is rendered by setting these slots in place, serializing the tree and
+    restoring the slots - the template is never copied or scanned per job.
+    The tree that is rendered is a copy that every thread makes once, so
+    threads never wait for each other and the template itself never changes.
+    '''
+
+    def __init__(self, name, xml, source=None):
+        self.name = name
+        self.xml = xml
+        self.source = source  # the config xml that was parsed into xml
+        self.lock = threading.RLock()
+        self.digest = hashlib.sha1(Job.canonicalize(xml)).hexdigest()
+
+        self._slots = {}
+        self._targets = {}
+        self._local = threading.local()
+        self.description = Job.find_description_el(xml)
+
+        # The position of every node, to find the same node in the copies.
+        self._index = dict((el, n) for n, el in enumerate(xml.iter()))
+
+    def __str__(self):
+        return self.name
+
+    def xpath(self, path):
+        '''Return the elements matching an xpath (evaluated only once).'''
+        try:
+            return self._slots[path]
+        except KeyError:
+            with self.lock:
+                return self._slots.setdefault(path, compile_xpath(path)(self.xml))
+
+    def substitution_targets(self, keys):
+        '''
+        Return a regex that matches any of keys (longest first) and the
+        text nodes that contain at least one of them, as (element, is_tail)
+        pairs.
+        '''
+        keys = tuple(sorted(set(keys), key=lambda k: (-len(k), k)))
+        try:
+            return self._targets[keys]
+        except KeyError:
+            pass
+
+        regex = re.compile('|'.join(re.escape(k) for k in keys)) if keys else None
+        with self.lock:
+            targets = []
+            if regex:
+                for text in compile_xpath('//text()')(self.xml):
+                    if regex.search(text):
+                        targets.append((text.getparent(), text.is_tail))
+            return self._targets.setdefault(keys, (regex, targets))
+
+    def render(self, text, tail=None, elements=()):
+        '''
+        Serialize the template with the text and tail of some elements
+        replaced and some new elements inserted. The template is left
+        unchanged.
+
+        :param text: mapping of template elements to their new text
+        :param tail: mapping of template elements to their new tail
+        :param elements: list of (parent, index, element) - index can be None
+        '''
+        tail = tail or {}
+        xml, nodes = self.thread_copy()
+        # Elements that are not in the template were created by the job.
+        node = lambda el: nodes[self._index[el]] if el in self._index else el
+
+        saved = [node(el) for el in set(text) | set(tail)]
+        saved = [(el, el.text, el.tail) for el in saved]
+        inserted = []
+        try:
+            for el, value in text.items():
+                node(el).text = value
+            for el, value in tail.items():
+                node(el).tail = value
+            for parent, index, el in elements:
+                parent = node(parent)
+                if index is None:
+                    parent.append(el)
+                else:
+                    parent.insert(index, el)
+                inserted.append((parent, el))
+            return Job.canonicalize(xml)
+        finally:
+            for parent, el in inserted:
+                parent.remove(el)
+            for el, text_value, tail_value in saved:
+                el.text, el.tail = text_value, tail_value
+
+    def thread_copy(self):
+        '''Return the current thread's copy of the tree and a list of its nodes.'''
+        try:
+            return self._local.copy
+        except AttributeError:
+            xml = copy.deepcopy(self.xml)
+            self._local.copy = xml, list(xml.iter())
+            return self._local.copy
+
+
 class Job(object):
-    def __init__(self, name, branch, template, jenkins):
+    def __init__(self, name, branch, template, jenkins, inventory=None):
         self.name = name
         self.branch = branch  # the scm branch that this job builds
         self.jenkins = jenkins
+        self.inventory = inventory
+        self.template = template
 
-        # This will be the new config.xml for the job we're creating.
-        self.xml = copy.deepcopy(template)
+        # The changes to make to the template for the job we're creating.
+        # After create(), self.xml is the new config.xml.
+        self.text = {}
+        self.tail = {}
+        self.elements = []
+        self.xml = None
 
-        # This is the raw config xml of the job  :todo: naming is mixed-up.
-        job = jenkins.job(name)
-        self.exists = job.exists
-        self.config = job.config if self.exists else None
+        if inventory is not None:
+            self.exists = inventory.job_exists(name)
+        else:
+            self.exists = jenkins.job(name).exists
+        self._config = None
+
+    # This is the raw config xml of the job  :todo: naming is mixed-up.
+    @property
+    def config(self):
+        '''Fetched on first use - only existing jobs that are compared cost a request.'''
+
+        if self._config is None and self.exists:
+            self._config = self.jenkins.job(self.name).config
+        return self._config
 
     def set_state(self, value):
         '''Set the state of newly created or overwritten job. One of:
@@ -31,30 +167,64 @@ class Job(object):
              'sticky'   -> New jobs inherit the state of the template job.
                            Overwritten jobs keep their previous state.
         '''
-        el = self.xml.xpath('disabled')[0]
+        el = self.template.xpath('disabled')[0]
 
         if value is True or value == 'true':
-            el.text = 'false'
+            self.set_text(el, 'false')
         elif value is False or value == 'false':
-            el.text = 'true'
+            self.set_text(el, 'true')
         elif value == 'template':
             pass
         elif value == 'sticky' and self.config:
             if '<disabled>false</disabled>' in self.config:
-                el.text = 'false'
+                self.set_text(el, 'false')
             if '<disabled>true</disabled>' in self.config:
-                el.text = 'true'
+                self.set_text(el, 'true')
+
+    def set_text(self, el, value):
+        self.text[el] = value
+
+    def set_or_create_text(self, path, parent, value):
+        '''Set the text of the first template element matching an xpath or,
+           if there is none, of a new element that is added under parent.'''
+        res = self.template.xpath(path)
+        if res:
+            self.set_text(res[0], value)
+        else:
+            el = lxml.etree.Element(path.lstrip('/'))
+            el.text = value
+            self.elements.append((parent, None, el))
+
+    def get_text(self, el):
+        return self.text.get(el, el.text)
+
+    def get_tail(self, el):
+        return self.tail.get(el, el.tail)
 
     def substitute(self, items, fmtdict, groups, groupdict):
-        for el in self.xml.xpath("//text()"):
-            for k, v in items:
-                if k in el:
-                    p = el.getparent()
-                    ctx = utils.merge(groupdict, fmtdict)
-                    nv = p.text.replace(k, v.format(*groups, **ctx))
-                    p.text = nv
-
-    def canonicalize(self, xml):
+        '''Replace all substitution keys in the text and tails of the template
+           in one pass. A value is formatted once, when its key is first found,
+           so the values of keys that are not in the template are never used.'''
+
+        ctx = utils.merge(groupdict, fmtdict)
+        items, values = dict(items), {}
+
+        def repl(match):
+            key = match.group(0)
+            if key not in values:
+                values[key] = items[key].format(*groups, **ctx)
+            return values[key]
+
+        regex, targets = self.template.substitution_targets(items)
+
+        for el, is_tail in targets:
+            if is_tail:
+                self.tail[el] = regex.sub(repl, self.get_tail(el))
+            else:
+                self.set_text(el, regex.sub(repl, self.get_text(el)))
+
+    @staticmethod
+    def canonicalize(xml):
         try:
             return lxml.etree.tostring(xml, method='c14n')
         except ValueError:
@@ -68,17 +238,18 @@ class Job(object):
 
             mark = xmlescape(mark)
             tag  = xmlescape(tag)
-            desc_el = Job.find_or_create_description_el(self.xml)
+            desc_el = self.find_or_create_description_el(self.template.description)
 
-            if desc_el.text is None:
-                desc_el.text = ''
-            if mark not in desc_el.text:
-                desc_el.text += mark
-            if tag not in desc_el.text:
-                desc_el.text += tag
+            text = self.get_text(desc_el) or ''
+            if mark not in text:
+                text += mark
+            if tag not in text:
+                text += tag
+            self.set_text(desc_el, text)
 
         elif method == 'element':
-            info_el = lxml.etree.SubElement(self.xml, 'createdByJenkinsAutojobs')
+            info_el = lxml.etree.Element('createdByJenkinsAutojobs')
+            self.elements.append((self.template.xml, None, info_el))
             ref_el  = lxml.etree.SubElement(info_el, 'ref')
             ref_el.text = xmlescape(self.branch)
 
@@ -91,8 +262,8 @@ class Job(object):
         # Mark build as created by jenkins-autojobs and add tags.
         self.tag_config(tag, tag_method)
 
-        # method='c14n' is only available in more recent versions of lxml
-        self.xml = self.canonicalize(self.xml)
+        # Render the new config.xml of the job from the template.
+        self.xml = self.template.render(self.text, self.tail, self.elements)
 
         if self.exists and overwrite:
             job_config_dom = lxml.etree.fromstring(self.config.encode('utf8'))
@@ -109,6 +280,8 @@ class Job(object):
         elif not self.exists:
             if not dryrun:
                 self.jenkins.job_create(self.name, self.xml)
+                if self.inventory is not None:
+                    self.inventory.add_job(self.name)
             print('. job created')
 
             # Build newly created job.
@@ -120,9 +293,8 @@ class Job(object):
         elif not overwrite:
             print('. overwrite disabled - skipping job')
 
-    @staticmethod
-    def find_or_create_description_el(xml):
-        parent, description = Job.find_description_el(xml)
+    def find_or_create_description_el(self, location):
+        parent, description = location
 
         if not description and parent is None:
             msg = 'cannot determine project type and the location of the description element'
@@ -130,7 +302,7 @@ class Job(object):
 
         if not description:
             description = lxml.etree.Element('description')
-            parent.insert(1, description)
+            self.elements.append((parent, 1, description))
         else:
             description = description[0]
         return description
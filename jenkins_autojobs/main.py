@@ -7,11 +7,19 @@ import os
 import re
 import sys
 import copy
+import json
+import time
+import random
+import hashlib
 import argparse
+import itertools
+import threading
+import traceback
 import subprocess
 
 from getpass import getpass
 from functools import partial
+from multiprocessing.pool import ThreadPool
 
 import lxml.etree
 import ruamel.yaml as yaml
@@ -21,6 +29,8 @@ from requests.exceptions import RequestException, HTTPError
 
 from . import __version__
 from . import utils, job
+from .inventory import Inventory
+from .state import State
 
 
 #-----------------------------------------------------------------------------
@@ -43,13 +53,25 @@ except NameError:
 
 #-----------------------------------------------------------------------------
 usage = '''\
-Usage: %s [options] <config.yaml>
+Usage: %s [options] <config.yaml> [<config.yaml|dir> ...]
 
 General Options:
   -n, --dry-run             simulate execution
   -v, --version             show version and exit
   -d, --debug               debug config inheritance
   -t, --debug-http          debug http requests
+  --jobs <num>              number of refs to process concurrently
+  --cleanup-jobs <num>      number of concurrent requests during cleanup
+  --state-file <path>       skip refs that did not change since the last run
+  --incremental             process only refs added since the last run
+  --batch-views             add jobs to views with one update per view
+  --daemon                  keep running and poll the repository
+  --poll-interval <sec>     seconds between polls in daemon mode
+  --webhook <[host:]port>   reconcile refs on push events posted to port
+  --ref <ref>               reconcile only this ref (can be repeated)
+  --refs-from <path>        reconcile only the refs in a file ('-' for stdin)
+                            with one ref or 'old new ref' line per ref
+  --max-age <duration>      skip refs with no commits in this long (ex: 30d)
 
 Repository Options:
   -r, --repo-url <arg>      repository url
@@ -65,13 +87,25 @@ Jenkins Options:
   --client-cert <path>      path to SSL client certificate
 
 A client certificate can be specified as a single file, containing the
-private key and certificate) or as 'path/to/client.cert:path/to/client.key'.\
+private key and certificate) or as 'path/to/client.cert:path/to/client.key'.
+
+Several configs (or directories of *.yaml configs) are run in a single
+process, sharing connections, templates and repository listings.\
 ''' % os.path.basename(sys.argv[0])
 
 
 #-----------------------------------------------------------------------------
-# The *global* connection to jenkins - assigned in main().
+# The *global* connection to jenkins, the snapshot of its jobs and views and
+# the persistent state (if any) - assigned in main().
 jenkins = None
+inventory = None
+state = None
+
+# The state files of a batch, by path (see run_batch()).
+states = {}
+
+# Serializes reconcile passes and the handling of push events.
+lock = threading.RLock()
 
 
 def parseopts(args):
@@ -81,6 +115,17 @@ def parseopts(args):
     opt('-v', '--version',    action='version', version='%(prog) version ' + __version__)
     opt('-d', '--debug',      action='store_true')
     opt('-t', '--debug-http', action='store_true')
+    opt('--jobs',             type=int)
+    opt('--cleanup-jobs',     type=int)
+    opt('--state-file')
+    opt('--incremental',      action='store_true')
+    opt('--batch-views',      action='store_true')
+    opt('--daemon',           action='store_true')
+    opt('--poll-interval',    type=float)
+    opt('--webhook')
+    opt('--ref',              action='append')
+    opt('--refs-from')
+    opt('--max-age',          type=utils.parse_duration)
     opt('--no-verify-ssl',    action='store_false', dest='verify_ssl')
     opt('--cert-bundle')
     opt('--client-cert')
@@ -92,19 +137,22 @@ def parseopts(args):
     opt('-j', '--jenkins-url')
     opt('-u', '--jenkins-user', type=utils.PromptArgtype(input,   'Jenkins User: '))
     opt('-p', '--jenkins-pass', type=utils.PromptArgtype(getpass, 'Jenkins Password: '))
-    opt('yamlconfig', metavar='config.yaml', type=argparse.FileType('r'), nargs="?")
+    opt('yamlconfig', metavar='config.yaml', nargs='*')
 
     return parser.parse_args(args)
 
 
-def main(argv, create_job, list_branches, config=None):
+def main(argv, create_job, list_branches, config=None, get_job_name=None):
     '''
     :param argv: command-line arguments to parse (defaults to sys.argv[1:])
     :param create_job: scm specific function that configures and creates jobs
     :param list_branches: scm specific function that lists all branches/refs
+                          as (name, revision) pairs
+    :param get_job_name: scm specific function that returns the name of the
+                         job for a ref (without creating it)
     :param getoptfmt: getopt short and long options
-    :param config: a config dictionary to use instead of parsing the
-                   configuration from yaml (useful for testing)
+    :param config: a config dictionary (or a list of them) to use instead of
+                   parsing the configuration from yaml (useful for testing)
     '''
 
     if '-h' in argv or '--help' in argv:
@@ -118,95 +166,779 @@ def main(argv, create_job, list_branches, config=None):
         print('error: config file not specified', file=sys.stderr)
         sys.exit(2)
 
+    # Several configs are run together in batch mode.
+    paths = get_config_paths(opts.yamlconfig)
+    if isinstance(config, list) or len(paths) > 1 or paths != opts.yamlconfig:
+        if opts.daemon or opts.webhook or opts.ref or opts.refs_from:
+            print('error: several configs cannot be used with --daemon, --webhook, --ref or --refs-from',
+                  file=sys.stderr)
+            sys.exit(2)
+
+        configs = config if isinstance(config, list) else paths
+        status = run_batch(configs, opts, create_job, list_branches, get_job_name)
+        sys.exit(status)
+
     # Load config, set default values and compile regexes.
     if not config:
-        print('loading config from "%s"' % os.path.abspath(opts.yamlconfig.name))
-        config = yaml.load(opts.yamlconfig)
+        print('loading config from "%s"' % os.path.abspath(paths[0]))
+        with open(paths[0]) as fh:
+            config = load_config(fh)
 
     config = c = get_default_config(config, opts)
 
     if config['debughttp']:
         enable_http_logging()
 
-    # Connect to jenkins.
+    global state
+    if config['state-file']:
+        state = main.state = State(config['state-file'])
+    elif config['daemon']:
+        # The daemon remembers the last poll in memory.
+        state = main.state = State(':memory:')
+    elif config['incremental']:
+        print('error: incremental mode requires a state file', file=sys.stderr)
+        sys.exit(2)
+
+    # Only the given refs are reconciled - the repository isn't listed.
+    targeted = bool(opts.ref or opts.refs_from)
+    if targeted and (config['daemon'] or config['webhook']):
+        print('error: --ref and --refs-from cannot be used with --daemon or --webhook', file=sys.stderr)
+        sys.exit(2)
+
+    # Connect to jenkins and take a snapshot of all its jobs and views
+    # (unless only a few refs are reconciled).
     try:
-        global jenkins
-        verify = c['cert-bundle'] if c['cert-bundle'] else c['verify-ssl']
-        jenkins = main.jenkins = Jenkins(c['jenkins'], c['username'], c['password'],
-                                         verify=verify, cert=c['client-cert'])
+        connect(c, full=not targeted)
     except (RequestException, JenkinsError) as e:
         print(e)
         sys.exit(1)
 
+    # Fetch the templates and check the views the config references.
+    templates = {}
+    if not prepare(config, templates):
+        sys.exit(1)
+
+    if targeted:
+        refs = [(ref, False) for ref in opts.ref or ()]
+        with utils.open_input(opts.refs_from) as fh:
+            if fh:
+                refs = itertools.chain(refs, utils.read_refs(fh))
+            status = run_refs(config, create_job, templates, refs, get_job_name)
+        sys.exit(status)
+
+    # Reconcile pushed refs as soon as they are received.
+    receiver = None
+    if config['webhook']:
+        from . import webhook
+        address = webhook.parse_address(config['webhook'])
+        receiver = webhook.Receiver(address, config, templates, create_job, get_job_name)
+        receiver.start()
+
+    if config['daemon']:
+        daemon(config, opts, create_job, list_branches, templates, receiver, get_job_name)
+        return
+
+    with lock:
+        status = run(config, create_job, list_branches, templates, get_job_name)
+
+    if receiver:
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            receiver.stop()
+    elif status:
+        sys.exit(status)
+
+def daemon(config, opts, create_job, list_branches, templates, receiver=None, get_job_name=None):
+    '''
+    Poll the repository until interrupted. The jenkins connection, the
+    compiled config and templates and the state of the last poll are kept
+    between polls, so only refs that appeared since the last poll are
+    processed (unless the config or the templates change). The yaml config
+    is re-read when it is modified. Polls are spread out with some jitter
+    and failed polls are retried with an exponential backoff.
+    '''
+
+    path = opts.yamlconfig[0] if opts.yamlconfig else None
+    mtime = os.path.getmtime(path) if path else None
+    failures = 0
+    ready = True
+
+    try:
+        while True:
+            start = time.time()
+            status = 1
+            if not ready:
+                print('\n. skipping poll - the templates or views are not ready')
+            else:
+                # A failed poll must not stop the daemon.
+                try:
+                    with lock:
+                        status = run(config, create_job, list_branches, templates, get_job_name)
+                except Exception:
+                    traceback.print_exc()
+
+            failures = failures + 1 if status else 0
+            delay = get_poll_delay(config['poll-interval'], config['poll-max-interval'], failures)
+            print('\n. poll finished in %.1fs - next poll in %.0fs' % (time.time() - start, delay))
+            time.sleep(delay)
+
+            # A poll with missing templates or views counts as a failed poll.
+            try:
+                with lock:
+                    # Reload the config if the config file changed.
+                    if path and os.path.getmtime(path) != mtime:
+                        mtime = os.path.getmtime(path)
+                        config = reload_config(config, opts, path)
+                        if receiver:
+                            receiver.config = config
+
+                    inventory.refresh()
+                    ready = prepare(config, templates)
+            except Exception:
+                traceback.print_exc()
+                ready = False
+    except KeyboardInterrupt:
+        if receiver:
+            receiver.stop()
+
+def reload_config(config, opts, path):
+    '''Re-read the yaml config and return it. Reconnect if the jenkins
+       settings changed. The whole config is compiled again, but templates
+       are only re-parsed if their config.xml changed (see prepare()).'''
+
+    global state
+    print('\nreloading config from "%s"' % os.path.abspath(path))
+    with open(path) as fh:
+        new = get_default_config(load_config(fh), opts)
+
+    if any(new[i] != config[i] for i in connection_keys):
+        connect(new)
+
+    if new['state-file'] != config['state-file']:
+        state.close()
+        state = main.state = State(new['state-file'] or ':memory:')
+
+    return new
+
+def get_poll_delay(interval, max_interval, failures=0, jitter=0.1):
+    '''
+    Seconds until the next poll - the interval doubles after every failed
+    poll (up to max_interval) and is randomly spread by +/- jitter.
+
+    >>> 90 <= get_poll_delay(100, 1000) <= 110
+    True
+    >>> 360 <= get_poll_delay(100, 1000, failures=2) <= 440
+    True
+    '''
+
+    delay = min(interval * 2 ** failures, max(interval, max_interval))
+    return delay * random.uniform(1 - jitter, 1 + jitter)
+
+# Config options that require reconnecting to jenkins when changed.
+connection_keys = 'jenkins', 'username', 'password', 'verify-ssl', 'cert-bundle', 'client-cert'
+
+def get_config_paths(paths):
+    '''Expand directories to the yaml configs they contain.'''
+
+    res = []
+    for path in paths or ():
+        if os.path.isdir(path):
+            names = sorted(os.listdir(path))
+            res.extend(os.path.join(path, i) for i in names if i.endswith(('.yaml', '.yml')))
+        else:
+            res.append(path)
+    return res
+
+def load_config(fh):
+    '''Parse a yaml config file.'''
+
+    config = yaml.load(fh)
+
+    # The state file is relative to the location of the config file.
+    if config.get('state-file'):
+        config_dir = os.path.dirname(os.path.abspath(fh.name))
+        config['state-file'] = os.path.join(config_dir, config['state-file'])
+
+    return config
+
+def connect(c, full=True):
+    '''Connect to jenkins and take a snapshot of all its jobs and views.'''
+
+    global jenkins, inventory
+    verify = c['cert-bundle'] if c['cert-bundle'] else c['verify-ssl']
+    jenkins = main.jenkins = Jenkins(c['jenkins'], c['username'], c['password'],
+                                     verify=verify, cert=c['client-cert'])
+    inventory = main.inventory = Inventory(jenkins, full)
+
+def prepare(config, templates, refresh=True):
+    '''
+    Check that all template jobs and views that the config references exist
+    and load the jobs in the views. The templates are compiled into the
+    templates dict, reusing the ones that it already holds if their config
+    did not change (or at all, if refresh is false). Returns False if
+    anything is missing.
+    '''
+
+    c = config
+
     #-------------------------------------------------------------------------
     # Get all the template names that the config references.
-    templates = set(i['template'] for i in c['refs'].values())
+    names = set(i['template'] for i in c['refs'].values())
 
     # Check if all referenced template jobs exist on the server.
-    missing = list(filterfalse(jenkins.job_exists, templates))
+    missing = list(filterfalse(inventory.job_exists, names))
     if missing:
         missing.insert(0, '\nconfig references non-existent template jobs:')
         print('\n - '.join(missing))
-        sys.exit(1)
+        return False
 
-    # Convert them to etree objects of the templates' config xmls.
-    templates = dict((i, get_job_etree(i)) for i in templates)
+    # Compile the templates' config xmls into render plans.
+    for name in names:
+        if name in templates and not refresh:
+            continue
+        source = jenkins.job(name).config
+        if name not in templates or templates[name].source != source:
+            xml = lxml.etree.fromstring(source.encode('utf8'))
+            templates[name] = job.Template(name, xml, source)
 
     #-------------------------------------------------------------------------
     # Check if all referenced views exist.
     view_names = set(view for i in c['refs'].values() for view in i['view'])
-    missing = list(filterfalse(jenkins.view_exists, view_names))
+    missing = list(filterfalse(inventory.view_exists, view_names))
     if missing:
         missing.insert(0, '\nconfig references non-existent views:')
         print('\n - '.join(missing))
-        sys.exit(1)
+        return False
+
+    # Load the jobs in each view once, instead of once per ref.
+    for view_name in view_names:
+        inventory.view_jobs(view_name)
+
+    return True
+
+def run(config, create_job, list_branches, templates, get_job_name=None):
+    '''Create or update the jobs for all refs and cleanup. Returns the exit status.'''
+
+    refs = list_refs(config, list_branches)
+    if isinstance(refs, Exception):
+        print_list_error(refs)
+        return 1
+
+    failed, job_names, vanished = update_jobs(config, create_job, templates, refs, get_job_name)
+    if failed:
+        return 1
+
+    if config['cleanup']:
+        job_names[config['template']] = {}
+        run_cleanup(config, job_names, vanished)
+
+    return 0
+
+def list_refs(config, list_branches):
+    '''
+    List all git refs, svn branches etc (implemented by child classes).
+    Returns a {ref: revision} dict or the exception if listing failed.
+
+    If 'max-age' is set, list_branches also returns the time of the last
+    commit of every ref, as (ref, revision, timestamp) tuples, and refs
+    older than that are left out.
+    '''
 
-    #-------------------------------------------------------------------------
-    # List all git refs, svn branches etc (implemented by child classes).
     try:
-        branches = list(list_branches(config))
+        refs = list(list_branches(config))
     except subprocess.CalledProcessError as e:
-        print('! cannot list branches')
-        print('! command %s failed' % ' '.join(e.cmd))
-        exit(1)
+        return e
+
+    if config['max-age'] is not None:
+        refs = prune_old_refs(refs, config['max-age'])
+    return OrderedDict(i[:2] for i in refs)
+
+def prune_old_refs(refs, max_age, now=None):
+    '''
+    Drop the refs whose last commit is more than max_age seconds old. Refs
+    without a timestamp are kept.
+
+    >>> prune_old_refs([('a', 1, 100), ('b', 2, 10), ('c', 3)], 50, now=120)
+    <BLANKLINE>
+    skipping 1 refs with no commits in the last 50 seconds
+    [('a', 1, 100), ('c', 3)]
+    '''
+
+    cutoff = (time.time() if now is None else now) - max_age
+
+    res = [i for i in refs if len(i) < 3 or i[2] is None or i[2] >= cutoff]
+    if len(res) != len(refs):
+        msg = '\nskipping %d refs with no commits in the last %d seconds'
+        print(msg % (len(refs) - len(res), max_age))
+    return res
+
+def print_list_error(error):
+    print('! cannot list branches')
+    print('! command %s failed' % ' '.join(error.cmd))
 
-    # See if any of the branches are ignored.
-    ignored, branches = get_ignored(branches, c['ignore'])
+def update_jobs(config, create_job, templates, refs, get_job_name=None):
+    '''
+    Create or update the jobs for refs, a {ref: revision} dict. Returns the
+    refs that failed, as (ref, traceback) pairs, a {job_name: config} dict
+    of the jobs of all other refs and the names of the jobs of the refs that
+    vanished since the last run (see get_vanished_jobs()).
+    '''
+
+    c = config
+    branches = list(refs)
+
+    # See if any of the branches are ignored and get the config of the rest.
+    ignored, configs = classify_refs(config, branches)
 
     if ignored:
         msg = ['\nexplicitly ignored:'] + ignored
         print('\n - '.join(msg))
 
-    # Get branch config for each branch.
-    configs = map(partial(resolveconfig, config), branches)
-    configs = zip(branches, configs)
-    configs = filter(lambda x: bool(x[1]), configs)
-
     # The names of all successfully created or updated jobs.
     job_names = {}
+    processed = []
+    failed = []
+
+    # In incremental mode, refs that were already processed by the last run
+    # are skipped, unless the config or any of the templates have changed.
+    if config['incremental']:
+        config_digest = get_config_digest(config, templates)
+        configs, unchanged = split_unchanged(config, refs, configs, config_digest)
+        for branch, branch_config, job_name in unchanged:
+            job_names[job_name] = branch_config
+            processed.append(branch)
+
+    process = partial(process_branch, create_job, templates, config)
+    for branch, branch_config, job_name, error in reconcile(process, configs, c['jobs']):
+        if error:
+            failed.append((branch, error))
+        else:
+            job_names[job_name] = branch_config
+            processed.append(branch)
+
+    # Apply the view additions that were collected in batch mode.
+    pending_views = inventory.pop_pending_views()
+    if pending_views:
+        add_pending_view_jobs(config, pending_views)
+
+    if failed:
+        print('\nfailed to process:')
+        for branch, error in failed:
+            print(' ! %s' % branch)
+            print('\n'.join('   ' + i for i in error.rstrip().splitlines()))
+        if config['cleanup']:
+            print('skipping cleanup because of failed refs')
+        return failed, job_names, None
+
+    vanished = None
+    if state is not None:
+        vanished = get_vanished_jobs(config, refs, processed, get_job_name)
+
+    # Forget about refs that no longer exist or are no longer processed.
+    if state is not None and not config['dryrun']:
+        state.prune_jobs(config['repo'], processed)
+        state.set_refs(config['repo'], refs.items())
+        state.set_meta(config['repo'], 'refs-time', str(time.time()))
+
+        if config['incremental']:
+            state.set_meta(config['repo'], 'config-digest', config_digest)
+
+    return failed, job_names, vanished
+
+def get_vanished_jobs(config, refs, processed, get_job_name=None):
+    '''
+    Return the names of the jobs of the refs that were processed or listed
+    by the last run, but that are not processed by this one, or None if the
+    last run left no ref listing. Job names are taken from the state file or
+    computed with the scm specific get_job_name().
+    '''
+
+    repo = config['repo']
+    if state.get_meta(repo, 'refs-time') is None:
+        return None
+
+    processed = set(processed)
+    recorded = state.get_jobs(repo)
+    names = set(name for ref, name in recorded.items() if ref not in processed)
+
+    # Refs that were listed, but whose job was not recorded.
+    gone = [ref for ref in state.get_refs(repo) if ref not in refs and ref not in recorded]
+    if gone and get_job_name:
+        ignored, configs = classify_refs(config, gone)
+        names.update(get_job_name(ref, config, ref_config) for ref, ref_config in configs)
+
+    return sorted(names)
+
+def run_cleanup(config, job_names, vanished, cache=None):
+    '''
+    Cleanup after a run. If the jobs of the refs that vanished since the last
+    run are known, only these are considered. All jobs are checked on the
+    first run and then at most every 'cleanup-full-interval' seconds. Returns
+    the removed jobs.
+    '''
+
+    repo = config['repo']
+    only = vanished
+    if state is None or vanished is None:
+        only = None
+    else:
+        last = state.get_meta(repo, 'cleanup-full-time')
+        if last is None or time.time() - float(last) >= config['cleanup-full-interval']:
+            only = None
+
+    if only is not None:
+        print('\nremoving the jobs of %d refs that vanished since the last run' % len(only))
+
+    removed = cleanup(config, job_names, jenkins, only=only, cache=cache)
+
+    if only is None and state is not None and not config['dryrun']:
+        state.set_meta(repo, 'cleanup-full-time', str(time.time()))
+    return removed
+
+def run_batch(configs, opts, create_job, list_branches, get_job_name=None):
+    '''
+    Run several configs (paths to yaml files or config dicts) in a single
+    process. Configs that use the same jenkins share a connection, the
+    inventory and the compiled templates. Repositories are listed
+    concurrently and only once per url. Cleanup runs after all configs were
+    processed, never removes jobs of any of the configs and lists all jobs
+    and their descriptions (and fetches the config of every job) only once.
+    Returns the exit status.
+    '''
+
+    global state
+
+    loaded = []
+    for config in configs:
+        name = config if not isinstance(config, dict) else config.get('repo')
+        if not isinstance(config, dict):
+            with open(config) as fh:
+                config = load_config(fh)
+        loaded.append((name, get_default_config(config, opts)))
+
+    if loaded and loaded[0][1]['debughttp']:
+        enable_http_logging()
+
+    # Configs that use the same jenkins are processed together.
+    groups = OrderedDict()
+    for name, config in loaded:
+        key = tuple(repr(config[i]) for i in connection_keys)
+        groups.setdefault(key, []).append((name, config))
+
+    report = []
+
+    def add_report(name, config, status, job_names=(), failed=()):
+        entry = {'name': name, 'repo': config['repo'], 'status': status,
+                 'jobs': len(job_names), 'failed': len(failed), 'removed': None}
+        report.append(entry)
+        return entry
+
+    # The state files are closed even if a config fails unexpectedly.
+    try:
+        for group in groups.values():
+            try:
+                connect(group[0][1])
+            except (RequestException, JenkinsError) as e:
+                print(e)
+                for name, config in group:
+                    add_report(name, config, 'cannot connect')
+                continue
+
+            # The state files are opened first, so that listings can use them.
+            for name, config in group:
+                path = config['state-file']
+                if path and path not in states:
+                    states[path] = State(path)
+
+            # List all repositories concurrently (once per repository).
+            jobs = max(config['jobs'] for name, config in group)
+            keys = OrderedDict((get_listing_key(config), config) for name, config in group)
+            listings = utils.parallel_map(partial(list_refs, list_branches=list_branches), keys.values(), jobs)
+            listings = dict(zip(keys, listings))
+
+            templates = {}
+            all_job_names = {}
+            cleanups = []
+
+            for name, config in group:
+                print('\n==== %s' % name)
+
+                state = main.state = states.get(config['state-file'])
+
+                if config['incremental'] and state is None:
+                    print('error: incremental mode requires a state file')
+                    add_report(name, config, 'error')
+                    continue
+
+                if not prepare(config, templates, refresh=False):
+                    add_report(name, config, 'error')
+                    continue
+
+                refs = listings[get_listing_key(config)]
+                if isinstance(refs, Exception):
+                    print_list_error(refs)
+                    add_report(name, config, 'error')
+                    continue
+
+                failed, job_names, vanished = update_jobs(config, create_job, templates, refs, get_job_name)
+                all_job_names.update(job_names)
+
+                entry = add_report(name, config, 'failed' if failed else 'ok', job_names, failed)
+                if config['cleanup'] and not failed:
+                    cleanups.append((entry, config, vanished))
+
+            # Cleanup, keeping the jobs of all configs (and all templates).
+            all_job_names.update((i, {}) for i in templates)
+            job_configs = {}
+            for entry, config, vanished in cleanups:
+                state = main.state = states.get(config['state-file'])
+                print('\n==== %s' % entry['name'])
+                entry['removed'] = len(run_cleanup(config, all_job_names, vanished, cache=job_configs))
+    finally:
+        for i in states.values():
+            i.close()
+        states.clear()
+        state = main.state = None
+
+    print('\nsummary:')
+    for entry in report:
+        msg = ' %s %s (%s): %s - %d jobs, %d failed'
+        msg = msg % ('!' if entry['status'] != 'ok' else '-', entry['name'], entry['repo'],
+                     entry['status'], entry['jobs'], entry['failed'])
+        if entry['removed'] is not None:
+            msg += ', %d removed' % entry['removed']
+        print(msg)
+
+    return 1 if any(entry['status'] != 'ok' for entry in report) else 0
+
+def get_listing_key(config):
+    '''Configs with the same key list the same refs.'''
+    return config['repo'], repr(config.get('branches'))
+
+def run_refs(config, create_job, templates, refs, get_job_name):
+    '''
+    Reconcile only the given refs, as (ref, deleted) pairs. Jobs are created
+    or updated for existing refs and removed for deleted refs (if cleanup is
+    enabled). The refs are consumed in chunks, so they can be streamed from
+    a large file. Returns the exit status.
+    '''
+
+    process = partial(process_branch, create_job, templates, config)
+    failed = []
+
+    for chunk in utils.chunked(refs, max(config['jobs'], 1) * 16):
+        # The last line for a ref wins.
+        chunk = OrderedDict(chunk)
+        ignored, configs = classify_refs(config, list(chunk))
+
+        if ignored:
+            msg = ['\nexplicitly ignored:'] + ignored
+            print('\n - '.join(msg))
+
+        updated = [(branch, cfg) for branch, cfg in configs if not chunk[branch]]
+        deleted = [(branch, cfg) for branch, cfg in configs if chunk[branch]]
+
+        for branch, branch_config, job_name, error in reconcile(process, updated, config['jobs']):
+            if error:
+                failed.append((branch, error))
+
+        if deleted:
+            remove_ref_jobs(config, deleted, get_job_name)
+
+    # Apply the view additions that were collected in batch mode.
+    pending_views = inventory.pop_pending_views()
+    if pending_views:
+        add_pending_view_jobs(config, pending_views)
+
+    if failed:
+        print('\nfailed to process:')
+        for branch, error in failed:
+            print(' ! %s' % branch)
+            print('\n'.join('   ' + i for i in error.rstrip().splitlines()))
+        return 1
+
+    return 0
+
+def split_unchanged(config, refs, configs, config_digest):
+    '''
+    Split configs into the refs that have to be processed and the refs that
+    were processed by the last run, given as (branch, branch_config, job_name).
+    Everything is processed if the config digest differs from the last run.
+    '''
+
+    repo = config['repo']
+    last_digest = state.get_meta(repo, 'config-digest')
+
+    if last_digest is None:
+        print('\nno previous run recorded - processing all refs')
+        return list(configs), []
+    if last_digest != config_digest:
+        print('\nconfig or templates changed since last run - processing all refs')
+        return list(configs), []
+
+    previous = state.get_refs(repo)
+    process, unchanged = [], []
+
     for branch, branch_config in configs:
-        tmpl = templates[branch_config['template']]
-        job_name = create_job(branch, tmpl, config, branch_config)
-        job_names[job_name] = branch_config
-
-        # Add newly create jobs to views, if any.
-        views = branch_config['view']
-        for view_name in views:
-            view = jenkins.view(view_name)
-            if job_name in view:
-                print('. job already in view: %s' % view_name)
-            else:
-                if not config['dryrun']:
-                    jenkins.view_add_job(view_name, job_name)
-                print('. job added to view: %s' % view_name)
+        last = state.get_job(repo, branch) if branch in previous else None
+        if last and inventory.job_exists(last[0]):
+            unchanged.append((branch, branch_config, last[0]))
+        else:
+            process.append((branch, branch_config))
 
-    if config['cleanup']:
-        job_names[config['template']] = {}
-        cleanup(config, job_names, jenkins)
+    removed = [ref for ref in previous if ref not in refs]
+    msg = '\nincremental: %d new, %d removed and %d unchanged refs'
+    print(msg % (len(process), len(removed), len(unchanged)))
+
+    return process, unchanged
+
+def process_branch(create_job, templates, config, branch, branch_config):
+    '''
+    Create or update the job for a branch and add it to its views. When a
+    state file is used, branches whose fingerprint matches the one recorded
+    after the last successful run are skipped, as long as their job exists.
+    '''
+
+    tmpl = templates[branch_config['template']]
+
+    fingerprint = None
+    if state is not None:
+        fingerprint = get_fingerprint(config, branch, branch_config, tmpl.digest)
+
+        last = state.get_job(config['repo'], branch)
+        if last and last[1] == fingerprint and inventory.job_exists(last[0]):
+            print('\nunchanged since last run: %s' % branch)
+            print('. job name: %s' % last[0])
+            return last[0]
+
+    job_name = create_job(branch, tmpl, config, branch_config)
+
+    # Add newly create jobs to views, if any.
+    views = branch_config['view']
+    for view_name in views:
+        if inventory.view_has_job(view_name, job_name):
+            print('. job already in view: %s' % view_name)
+        elif config['batch-views']:
+            inventory.view_add_job(view_name, job_name, pending=True)
+            print('. job will be added to view: %s' % view_name)
+        else:
+            if not config['dryrun']:
+                jenkins.view_add_job(view_name, job_name)
+                inventory.view_add_job(view_name, job_name)
+            print('. job added to view: %s' % view_name)
+
+    if fingerprint and not config['dryrun']:
+        state.set_job(config['repo'], branch, job_name, fingerprint)
+
+    return job_name
+
+def reconcile(process, configs, jobs=1):
+    '''
+    Call process(branch, branch_config) for every branch and yield tuples of
+    (branch, branch_config, job_name, error) in the order of configs.
+
+    With more than one job, branches are processed by a pool of worker
+    threads. The output of every branch is buffered and written out in
+    order, and exceptions are returned as formatted tracebacks instead of
+    being raised. With a single job, exceptions propagate as usual.
+    '''
+
+    if jobs <= 1:
+        for branch, branch_config in configs:
+            yield branch, branch_config, process(branch, branch_config), None
+        return
+
+    stdout = sys.stdout = utils.ThreadLocalOutput(sys.stdout)
+
+    def worker(args):
+        branch, branch_config = args
+        job_name, error = None, None
+        with stdout.capture() as buf:
+            try:
+                job_name = process(branch, branch_config)
+            except Exception:
+                error = traceback.format_exc()
+        return branch, branch_config, job_name, error, buf.getvalue()
+
+    pool = ThreadPool(jobs)
+    try:
+        for branch, branch_config, job_name, error, output in pool.imap(worker, configs):
+            stdout.write(output)
+            yield branch, branch_config, job_name, error
+    finally:
+        pool.terminate()
+        sys.stdout = stdout.stream
+
+def add_pending_view_jobs(config, pending_views):
+    print('\nadding jobs to views:')
+
+    for view_name, job_names in sorted(pending_views.items()):
+        if config['dryrun']:
+            print(' + %s: %d jobs' % (view_name, len(job_names)))
+            continue
+
+        remaining = update_view_jobs(jenkins, view_name, job_names)
+        print(' + %s: %d jobs' % (view_name, len(job_names) - len(remaining)))
+
+        # Views without a list of job names, or ones that kept changing
+        # underneath us, get their jobs added one at a time.
+        for job_name in remaining:
+            jenkins.view_add_job(view_name, job_name)
+            print(' + %s: %s' % (view_name, job_name))
+
+def update_view_jobs(jenkins, view_name, job_names, retries=3):
+    '''
+    Add jobs to a view with a single update of its config.xml. The config is
+    re-read right before the update and is not written if it changed since
+    it was read (by another process or user). Returns the jobs that are not
+    in the view afterwards, so that they can be added one at a time (e.g.
+    the view has no 'jobNames' element or it kept changing).
+    '''
+
+    view = jenkins.view(view_name)
+
+    with lock:
+        for attempt in range(retries):
+            source = view.config
+            xml = lxml.etree.fromstring(source.encode('utf8'))
+            names_el = xml.find('jobNames')
+            if names_el is None:
+                return list(job_names)
+
+            current = set(names_el.xpath('string/text()'))
+            missing = [i for i in job_names if i not in current]
+            if not missing:
+                return []
+
+            for job_name in missing:
+                lxml.etree.SubElement(names_el, 'string').text = job_name
+
+            if view.config == source:
+                view.config = lxml.etree.tostring(xml)
+
+        current = set(view.config_etree.xpath('jobNames/string/text()'))
+        return [i for i in job_names if i not in current]
 
 #-----------------------------------------------------------------------------
-def cleanup(config, created_job_names, jenkins, verbose=True):
+def cleanup(config, created_job_names, jenkins, verbose=True, only=None, cache=None):
+    '''
+    Remove the managed jobs that are not in created_job_names and return
+    them. If only is given, consider just the jobs with these names instead
+    of all jobs. Job configs, the list of all jobs and their descriptions
+    are looked up in and added to cache, if given. With the description
+    tag-method, a full cleanup lists the descriptions of all jobs with the
+    tree api instead of fetching the config.xml of every job. A targeted
+    cleanup fetches only the descriptions of the given jobs.
+    '''
+
     print('\ncleaning up old jobs:')
+    start = time.time()
+
+    if only is not None and not only:
+        print('. nothing to do')
+        return []
 
     filter_function = partial(
         filter_jobs,
@@ -214,25 +946,49 @@ def cleanup(config, created_job_names, jenkins, verbose=True):
         by_name_regex=config['cleanup-filters']['jobs']
     )
 
-    removed_jobs = []
-    managed_jobs = get_managed_jobs(created_job_names, jenkins, filter_function)
-
-    for job, job_config in managed_jobs:
-        # If cleanup is a tag name, only cleanup builds with that tag.
-        if isinstance(config['cleanup'], str):
-            clean_tags = get_autojobs_tags(job_config, config['tag-method'])
-            if not config['cleanup'] in clean_tags:
-                if config['debug']:
-                    print('. skipping %s' % job.name)
-                continue
+    if only is not None:
+        filter_function = partial(filter_only, filter_function, config, set(only))
+    else:
+        all_jobs = cached(cache, 'jobs', lambda: jenkins.jobs)
+        filter_function = partial(filter_function, all_jobs=all_jobs)
+
+    method = config['tag-method']
+    descriptions = None
+    if method == 'description' and only is None:
+        descriptions = cached(cache, 'descriptions', lambda: get_job_descriptions(jenkins))
+
+    progress = utils.Counter()
+    managed_jobs = get_managed_jobs(
+        created_job_names, jenkins, filter_function,
+        jobs=config['cleanup-jobs']['fetch'], progress=progress, cache=cache,
+        tag_method=method, descriptions=descriptions
+    )
 
-        removed_jobs.append(job)
-        if not config['dryrun']:
-            job_removed = safe_job_delete(job)
-        else:
-            job_removed = True
+    def removable_jobs():
+        for job, job_config in managed_jobs:
+            # If cleanup is a tag name, only cleanup builds with that tag.
+            if isinstance(config['cleanup'], str):
+                if method == 'description':
+                    clean_tags = get_description_tags(job_config)
+                else:
+                    clean_tags = get_autojobs_tags(job_config, method)
+                if not config['cleanup'] in clean_tags:
+                    if config['debug']:
+                        print('. skipping %s' % job.name)
+                    continue
+            yield job
+
+    def remove(job):
+        if config['dryrun']:
+            return job, True
+        return job, safe_job_delete(job)
 
+    removed_jobs = []
+    for job, job_removed in utils.parallel_map(remove, removable_jobs(), config['cleanup-jobs']['delete']):
+        removed_jobs.append(job)
         if job_removed:
+            if inventory is not None:
+                inventory.remove_job(job.name)
             print(' - %s' % job.name)
         else:
             print(' ! permission denied for %s' % job.name)
@@ -240,6 +996,20 @@ def cleanup(config, created_job_names, jenkins, verbose=True):
     if not removed_jobs:
         print('. nothing to do')
 
+    # Later cleanups that share the cache must not see the removed jobs.
+    if cache is not None and removed_jobs:
+        names = set(job.name for job in removed_jobs)
+        if 'jobs' in cache:
+            cache['jobs'] = [job for job in cache['jobs'] if job.name not in names]
+        for name in names:
+            cache.get('descriptions', {}).pop(name, None)
+
+    if verbose:
+        msg = '. checked %d jobs and removed %d in %.1fs'
+        print(msg % (progress.value, len(removed_jobs), time.time() - start))
+
+    return removed_jobs
+
 def get_autojobs_tags(job_config, method):
     xml = lxml.etree.fromstring(job_config.encode('utf8'))
     if method == 'element':
@@ -247,18 +1017,61 @@ def get_autojobs_tags(job_config, method):
 
     elif method == 'description':
         _, description = job.Job.find_description_el(xml)
-        description = description[0].text if description else ''
-        tags = re.findall(r'\n\(jenkins-autojobs-tag: (.*)\)', description)
+        return get_description_tags(description[0].text if description else '')
 
     tags = tags[0].split() if tags else []
     return tags
 
-def filter_jobs(jenkins, by_views=(), by_name_regex=()):
-    '''Select only jobs that belong to a given view or the names of which match a regex.'''
+def get_description_tags(description):
+    '''
+    >>> get_description_tags('Build\\n(created by jenkins-autojobs)\\n(jenkins-autojobs-tag: a b)')
+    ['a', 'b']
+    '''
+    tags = re.findall(r'\n\(jenkins-autojobs-tag: (.*)\)', description or '')
+    return tags[0].split() if tags else []
+
+def filter_only(filter_function, config, names, jenkins):
+    '''Select only the existing jobs with the given names that pass the cleanup filters.'''
+    if config['cleanup-filters']['views'] or config['cleanup-filters']['jobs']:
+        return [job for job in filter_function(jenkins) if job.name in names]
+    return [jenkins.job(name) for name in names if inventory.job_exists(name)]
+
+def remove_ref_jobs(config, configs, get_job_name):
+    '''
+    Remove the jobs of refs that no longer exist, given as (ref, config)
+    pairs. Job names are taken from the state file or computed with the
+    scm specific get_job_name(). Only jobs created by jenkins-autojobs are
+    removed and only if cleanup is enabled.
+    '''
+
+    job_names = []
+    for branch, branch_config in configs:
+        last = state.get_job(config['repo'], branch) if state is not None else None
+        if last:
+            job_names.append(last[0])
+        elif get_job_name:
+            job_names.append(get_job_name(branch, config, branch_config))
+
+    if not config['cleanup']:
+        print('\ncleanup disabled - not removing: %s' % ', '.join(job_names))
+        return
+
+    templates = set(i['template'] for i in config['refs'].values())
+    cleanup(config, templates, jenkins, only=job_names)
+
+    if state is not None and not config['dryrun']:
+        for branch, branch_config in configs:
+            state.remove_job(config['repo'], branch)
+
+def filter_jobs(jenkins, by_views=(), by_name_regex=(), all_jobs=None):
+    '''Select only jobs that belong to a given view or the names of which match
+       a regex. All jobs are listed, unless they are given in all_jobs.'''
     jobs = set()
+    if all_jobs is None:
+        all_jobs = jenkins.jobs
 
     if not by_views and not by_name_regex:
-        return jenkins.jobs
+        return all_jobs
 
     # Select jobs in the by_views list.
     for view_name in by_views:
@@ -266,36 +1079,98 @@ def filter_jobs(jenkins, by_views=(), by_name_regex=()):
         jobs.update(view_jobs)  # set.update() is a union operation.
 
     # Select jobs names that match the by_name_regex list.
-    for job in jenkins.jobs:
+    for job in all_jobs:
         if utils.anymatch(by_name_regex, job.name):
             jobs.add(job)
 
     return jobs
 
-def get_managed_jobs(created_job_names, jenkins, filter_function=None, safe_codes=(403,)):
+def cached(cache, key, fetch):
+    '''Return cache[key], adding it with fetch() if missing (or if cache is None).'''
+    if cache is None:
+        return fetch()
+    if key not in cache:
+        cache[key] = fetch()
+    return cache[key]
+
+def get_job_descriptions(jenkins, page_size=2000):
+    '''
+    Return the descriptions of all jobs as a {name: description} dict. Jobs
+    are listed with the tree api, page_size jobs per request.
+    '''
+
+    descriptions = {}
+    for start in itertools.count(0, page_size):
+        url = 'api/json?tree=jobs[name,description]{%d,%d}' % (start, start + page_size)
+        res = jenkins.server.json(url, 'unable to retrieve job descriptions')
+
+        size = len(descriptions)
+        for i in res.get('jobs', ()):
+            descriptions[i['name']] = i.get('description') or ''
+
+        # Older versions of Jenkins ignore the range and return all jobs.
+        if len(descriptions) - size < page_size:
+            break
+
+    return descriptions
+
+def get_managed_jobs(created_job_names, jenkins, filter_function=None, safe_codes=(403,),
+                     jobs=1, progress=None, cache=None, tag_method='element',
+                     descriptions=None):
     '''
-    Returns jobs which were created by jenkins-autojobs. This is determined by
-    looking for a special string or element in the job's config.xml.
+    Returns jobs which were created by jenkins-autojobs as (job, text) pairs.
+    This is determined by looking for a special string or element in the
+    job's config.xml or, with the description tag_method, for a special
+    string in the job's description. Descriptions are taken from the
+    descriptions dict, if given. Up to `jobs` config.xmls or descriptions
+    are fetched concurrently (unless they are in cache).
     '''
 
     tag_el = '</createdByJenkinsAutojobs>'
     tag_desc = '(created by jenkins-autojobs)'
 
     if callable(filter_function):
-        jobs = filter_function(jenkins)
+        candidates = filter_function(jenkins)
     else:
-        jobs = jenkins.jobs
+        candidates = jenkins.jobs
 
-    for job in jobs:
-        if job.name in created_job_names:
-            continue
+    candidates = [job for job in candidates if job.name not in created_job_names]
+
+    by_description = tag_method == 'description'
+
+    def fetch(job):
+        if by_description and descriptions is not None:
+            return job, descriptions.get(job.name)
+        key = ('description' if by_description else 'config', job.name)
+        if cache is not None and key in cache:
+            return job, cache[key]
         try:
-            job_config = job.config
-            if (tag_desc in job_config) or (tag_el in job_config):
-                yield job, job_config
+            if by_description:
+                url = job.url('api/json?tree=description')
+                job_config = job.server.json(url).get('description') or ''
+            else:
+                job_config = job.config
         except HTTPError as error:
             if error.response.status_code not in safe_codes:
                 raise
+            job_config = None
+        if cache is not None:
+            cache[key] = job_config
+        return job, job_config
+
+    for job, job_config in utils.parallel_map(fetch, candidates, jobs):
+        if progress is not None:
+            progress.increment()
+            if progress.value % 1000 == 0:
+                print('. checked %d of %d jobs' % (progress.value, len(candidates)))
+
+        if not job_config:
+            continue
+        if by_description:
+            if tag_desc in job_config:
+                yield job, job_config
+        elif (tag_desc in job_config) or (tag_el in job_config):
+            yield job, job_config
 
 def safe_job_delete(job, safe_codes=(403,)):
     try:
@@ -326,6 +1201,17 @@ def get_default_config(config, opts):
     c['client-cert']  = config.get('client-cert', None)
     c['tag-method']   = config.get('tag-method', 'description')
     c['cleanup-filters'] = config.get('cleanup-filters', {})
+    c['jobs']         = config.get('jobs', 1)
+    c['state-file']   = config.get('state-file', None)
+    c['incremental']  = config.get('incremental', False)
+    c['batch-views']  = config.get('batch-views', False)
+    c['daemon']       = config.get('daemon', False)
+    c['poll-interval'] = config.get('poll-interval', 60)
+    c['poll-max-interval'] = config.get('poll-max-interval', 900)
+    c['webhook']      = config.get('webhook', None)
+    c['webhook-secret'] = config.get('webhook-secret', None)
+    c['max-age']      = config.get('max-age', None)
+    c['cleanup-full-interval'] = config.get('cleanup-full-interval', '1d')
 
     # Default settings for each git ref/branch config.
     c['defaults'] = {
@@ -348,12 +1234,24 @@ def get_default_config(config, opts):
     # Make sure some options are always lists.
     c['defaults']['view'] = utils.pluralize(c['defaults']['view'])
 
+    # Compile sanitize rules.
+    c['defaults']['sanitize'] = utils.Sanitizer(c['defaults']['sanitize'])
+
     # Options that can be overwritten from the command-line.
     if o.repo_url:     c['repo'] = opts.repo_url
     if o.jenkins_url:  c['jenkins'] = opts.jenkins_url
     if o.dry_run:      c['dryrun'] = True
     if o.debug:        c['debug'] = True
     if o.debug_http:   c['debughttp'] = True
+    if o.jobs:         c['jobs'] = o.jobs
+    if o.cleanup_jobs: c['cleanup-jobs'] = o.cleanup_jobs
+    if o.state_file:   c['state-file'] = o.state_file
+    if o.incremental:  c['incremental'] = True
+    if o.batch_views:  c['batch-views'] = True
+    if o.daemon:       c['daemon'] = True
+    if o.poll_interval: c['poll-interval'] = o.poll_interval
+    if o.webhook:      c['webhook'] = o.webhook
+    if o.max_age:      c['max-age'] = o.max_age
     if o.cert_bundle:  c['cert-bundle'] = opts.cert_bundle
     if o.client_cert:  c['client-cert'] = opts.client_cert
     if not o.verify_ssl:  c['verify-ssl'] = opts.verify_ssl
@@ -366,6 +1264,23 @@ def get_default_config(config, opts):
     if o.scm_user: c['scm-username'] = o.scm_user
     if o.scm_pass: c['scm-password'] = o.scm_pass
 
+    # Cleanup parallelism defaults to the number of jobs and can be set
+    # separately for config.xml fetches and deletes.
+    cleanup_jobs = c.get('cleanup-jobs', c['jobs'])
+    if not isinstance(cleanup_jobs, dict):
+        cleanup_jobs = {'fetch': cleanup_jobs, 'delete': cleanup_jobs}
+    cleanup_jobs.setdefault('fetch', c['jobs'])
+    cleanup_jobs.setdefault('delete', c['jobs'])
+    c['cleanup-jobs'] = cleanup_jobs
+
+    if c['max-age'] is not None:
+        c['max-age'] = utils.parse_duration(c['max-age'])
+    c['cleanup-full-interval'] = utils.parse_duration(c['cleanup-full-interval'])
+
+    # The daemon only processes the refs that appeared since the last poll.
+    if c['daemon']:
+        c['incremental'] = True
+
     # Compile ignore regexes.
     c.setdefault('ignore', {})
     c['ignore'] = [re.compile(i) for i in c['ignore']]
@@ -388,6 +1303,10 @@ def get_default_config(config, opts):
     cfg = get_effective_branch_config(c['refs'], c['defaults'])
     c['refs'] = cfg
 
+    # Ignore and ref regexes are matched together, ignore regexes first.
+    pairs = [(regex, None) for regex in c['ignore']] + list(cfg.items())
+    c['matcher'] = utils.RefMatcher(pairs)
+
     return c
 
 #-----------------------------------------------------------------------------
@@ -403,6 +1322,8 @@ def get_effective_branch_config(branches, defaults):
             key, overrides = list(entry.items())[0]
             config = defaults.copy()
             config.update(overrides)
+            if not isinstance(config['sanitize'], utils.Sanitizer):
+                config['sanitize'] = utils.Sanitizer(config['sanitize'])
             ec[re.compile(key)] = config
         else:
             ec[re.compile(entry)] = defaults
@@ -415,26 +1336,47 @@ def get_effective_branch_config(branches, defaults):
 
     return ec
 
-def get_ignored(branches, regexes):
-    '''Get refs, excluding ignored.'''
+def classify_refs(effective_config, branches):
+    '''
+    Split refs into ignored refs and (ref, effective config) pairs for the
+    refs that match a ref regex. Ignore regexes are matched first and every
+    ref is looked up only once.
+    '''
 
-    isignored = partial(utils.anymatch, regexes)
-    ignored, branches = utils.filtersplit(isignored, branches)
+    matcher = effective_config['matcher']
+    ignored, configs = [], []
 
-    return ignored, branches
+    for branch in branches:
+        res = matcher.match(branch)
+        if res is None:
+            continue
+        regex, config = res
+        if config is None:
+            ignored.append(branch)
+        else:
+            config['re'] = regex
+            configs.append((branch, config.copy()))
 
-def resolveconfig(effective_config, branch):
-    '''Resolve a ref to its effective config.'''
+    return ignored, configs
 
-    for regex, config in effective_config['refs'].items():
-        if regex.match(branch):
-            config['re'] = regex
-            return config.copy()
+def get_config_digest(config, templates):
+    '''Digest of the effective config of all refs and of all templates.'''
 
-def get_job_etree(job):
-    res = jenkins.job(job).config
-    res = lxml.etree.fromstring(res.encode('utf8'))
-    return res
+    template_digests = dict((name, tmpl.digest) for name, tmpl in templates.items())
+
+    refs = [(regex.pattern, ref_config) for regex, ref_config in config['refs'].items()]
+    ignore = [regex.pattern for regex in config['ignore']]
+
+    data = [__version__, config['repo'], config['tag-method'], refs, ignore, template_digests]
+    data = json.dumps(data, sort_keys=True, default=repr)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
+
+def get_fingerprint(config, branch, branch_config, template_digest):
+    '''Digest of everything that goes into the config.xml of a branch's job.'''
+
+    data = [__version__, config['repo'], config['tag-method'], branch, template_digest, branch_config]
+    data = json.dumps(data, sort_keys=True, default=repr)
+    return hashlib.sha1(data.encode('utf8')).hexdigest()
 
 def debug_refconfig(ref_config):
     print('. config:')
@@ -0,0 +1,128 @@
+# -*- coding: utf-8; -*-
+
+from __future__ import absolute_import
+
+import json
+import sqlite3
+import threading
+
+
+class State(object):
+    '''
+    Persistent state that is carried over between runs. This is a sqlite
+    database that maps every processed ref to the name of its job and the
+    fingerprint of the config that was last pushed for it. It also keeps the
+    ref listing of the last complete run of every repository and the cached
+    listings of svn directories.
+    '''
+
+    schema = '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        repo        TEXT NOT NULL,
+        ref         TEXT NOT NULL,
+        job_name    TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        PRIMARY KEY (repo, ref)
+    );
+
+    CREATE TABLE IF NOT EXISTS refs (
+        repo     TEXT NOT NULL,
+        ref      TEXT NOT NULL,
+        revision TEXT,
+        PRIMARY KEY (repo, ref)
+    );
+
+    CREATE TABLE IF NOT EXISTS listings (
+        url       TEXT NOT NULL,
+        recursive INTEGER NOT NULL,
+        revision  TEXT NOT NULL,
+        listing   TEXT NOT NULL,
+        PRIMARY KEY (url, recursive)
+    );
+
+    CREATE TABLE IF NOT EXISTS meta (
+        repo  TEXT NOT NULL,
+        key   TEXT NOT NULL,
+        value TEXT,
+        PRIMARY KEY (repo, key)
+    );
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript(self.schema)
+
+    def get_job(self, repo, ref):
+        '''Return the (job_name, fingerprint) last recorded for a ref or None.'''
+        sql = 'SELECT job_name, fingerprint FROM jobs WHERE repo = ? AND ref = ?'
+        with self.lock:
+            return self.db.execute(sql, (repo, ref)).fetchone()
+
+    def set_job(self, repo, ref, job_name, fingerprint):
+        sql = 'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)'
+        with self.lock, self.db:
+            self.db.execute(sql, (repo, ref, job_name, fingerprint))
+
+    def remove_job(self, repo, ref):
+        sql = 'DELETE FROM jobs WHERE repo = ? AND ref = ?'
+        with self.lock, self.db:
+            self.db.execute(sql, (repo, ref))
+
+    def get_jobs(self, repo):
+        '''Return the jobs of a repository as a {ref: job_name} dict.'''
+        sql = 'SELECT ref, job_name FROM jobs WHERE repo = ?'
+        with self.lock:
+            return dict(self.db.execute(sql, (repo,)))
+
+    def prune_jobs(self, repo, refs):
+        '''Forget all refs of a repository that are not in refs.'''
+        refs = set(refs)
+        sql = 'SELECT ref FROM jobs WHERE repo = ?'
+        with self.lock, self.db:
+            stale = [(repo, i) for i, in self.db.execute(sql, (repo,)) if i not in refs]
+            self.db.executemany('DELETE FROM jobs WHERE repo = ? AND ref = ?', stale)
+        return [ref for _, ref in stale]
+
+    def get_refs(self, repo):
+        '''Return the last ref listing of a repository as a {ref: revision} dict.'''
+        sql = 'SELECT ref, revision FROM refs WHERE repo = ?'
+        with self.lock:
+            return dict(self.db.execute(sql, (repo,)))
+
+    def set_refs(self, repo, refs):
+        '''Replace the ref listing of a repository with refs (ref, revision) pairs.'''
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM refs WHERE repo = ?', (repo,))
+            self.db.executemany('INSERT INTO refs VALUES (?, ?, ?)',
+                                ((repo, ref, rev) for ref, rev in refs))
+
+    def get_listing(self, url, recursive=False):
+        '''Return the (revision, [(name, revision)]) listing last recorded for
+           a directory or None.'''
+        sql = 'SELECT revision, listing FROM listings WHERE url = ? AND recursive = ?'
+        with self.lock:
+            row = self.db.execute(sql, (url, int(recursive))).fetchone()
+        return (row[0], [tuple(i) for i in json.loads(row[1])]) if row else None
+
+    def set_listing(self, url, recursive, revision, listing):
+        sql = 'INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)'
+        with self.lock, self.db:
+            self.db.execute(sql, (url, int(recursive), revision, json.dumps(listing)))
+
+    def get_meta(self, repo, key, default=None):
+        sql = 'SELECT value FROM meta WHERE repo = ? AND key = ?'
+        with self.lock:
+            row = self.db.execute(sql, (repo, key)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, repo, key, value):
+        sql = 'INSERT OR REPLACE INTO meta VALUES (?, ?, ?)'
+        with self.lock, self.db:
+            self.db.execute(sql, (repo, key, value))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -10,13 +10,42 @@ from __future__ import absolute_import
 
 import os
 import sys
+import time
+import calendar
+import fnmatch
+import threading
 import subprocess
 
+from functools import partial
+from contextlib import contextmanager
+
+import lxml.etree
+
 from . import job, main, utils
+from .state import State
+
+
+#-----------------------------------------------------------------------------
+# The Subversion Python bindings are optional.
+try:
+    from svn import core as svn_core, ra as svn_ra
+except ImportError:
+    svn_core = svn_ra = None
 
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote as _unquote
 
-def svn_ls(url, username=None, password=None, dirsonly=True):
-    cmd = ['svn', 'ls', '--trust-server-cert', '--non-interactive']
+    def unquote(url):
+        if isinstance(url, unicode):
+            url = url.encode('utf8')
+        return _unquote(url).decode('utf8')
+
+
+#-----------------------------------------------------------------------------
+def svn_cmd(subcommand, username=None, password=None):
+    cmd = ['svn', subcommand, '--xml', '--trust-server-cert', '--non-interactive']
 
     # :todo: plaintext (will probably have to use the bindings).
     if username:
@@ -24,64 +53,437 @@ def svn_ls(url, username=None, password=None, dirsonly=True):
     if password:
         cmd += ['--password', password]
 
+    return cmd
+
+def svn_xml_iter(cmd, tag='entry', check=True):
+    '''
+    Run a svn command with xml output and yield its tag elements as they
+    are parsed. Elements are cleared once the caller moves on to the next
+    one, so that large listings are never fully kept in memory. Raises
+    CalledProcessError if the command fails (unless check is false).
+    '''
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    finished = False
+    try:
+        for _, el in lxml.etree.iterparse(process.stdout, tag=tag):
+            yield el
+            el.clear()
+        finished = True
+    except lxml.etree.XMLSyntaxError:
+        # A failed command may produce incomplete (or no) output.
+        finished = True
+    finally:
+        process.stdout.close()
+        if not finished:
+            process.kill()
+        retcode = process.wait()
+
+    if retcode and check:
+        raise subprocess.CalledProcessError(retcode, cmd)
+
+def svn_ls(url, username=None, password=None, dirsonly=True, recursive=False):
+    '''List a directory as (name, last changed revision, last changed time)
+       tuples. The names in a recursive listing are paths relative to url.'''
+
+    cmd = svn_cmd('ls', username, password)
+    if recursive:
+        cmd.append('--recursive')
     cmd.append(url)
-    out = utils.check_output(cmd).decode('utf8').split(os.linesep)
 
-    if dirsonly:
-        out = [i.rstrip('/') for i in out if i.endswith('/')]
+    res = []
+    for entry in svn_xml_iter(cmd):
+        if dirsonly and entry.get('kind') != 'dir':
+            continue
+        commit = entry.find('commit')
+        date = parse_date(commit.findtext('date'))
+        res.append((entry.findtext('name'), commit.get('revision'), date))
 
-    return out
+    return res
 
-def svn_wildcard_ls(url, repo, username=None, password=None, dirsonly=True):
-    left, wcard, right = url.partition('*')
-    right = right.lstrip('/')
-    branches = []
+def parse_date(value):
+    '''
+    Convert a svn date to a unix timestamp.
+
+    >>> parse_date('2016-03-03T12:00:00.123456Z')
+    1457006400
+    '''
+
+    if not value:
+        return None
+    return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
+def svn_info(urls, username=None, password=None):
+    '''Return the last changed revision of several urls as a {url: revision}
+       dict. Urls that could not be looked up are left out.'''
+
+    res = {}
+
+    # Keep the command line short, whatever the number of urls.
+    for chunk in utils.chunked(urls, info_chunk_size):
+        cmd = svn_cmd('info', username, password) + chunk
+
+        # Svn reports urls %-encoded, which the requested urls may not be.
+        requested = dict((unquote(url).rstrip('/'), url) for url in chunk)
+
+        for entry in svn_xml_iter(cmd, check=False):
+            url, commit = entry.findtext('url'), entry.find('commit')
+            url = requested.get(unquote(url or '').rstrip('/'))
+            if url and commit is not None:
+                res[url] = commit.get('revision')
+
+    return res
+
+info_chunk_size = 100
+
+class SvnCli(object):
+    '''Lists directories by running the svn command-line client.'''
+
+    def __init__(self, username=None, password=None):
+        self.username = username
+        self.password = password
+
+    def ls(self, url, recursive=False):
+        return svn_ls(url, self.username, self.password, recursive=recursive)
+
+    def info(self, urls):
+        return svn_info(urls, self.username, self.password)
+
+class SvnBindings(object):
+    '''
+    Lists directories with the Subversion Python bindings. Authenticated RA
+    sessions are kept in a pool and reused for every url in the repository
+    that they were opened for. A session is used by one thread at a time,
+    so there are at most as many sessions per repository as there are
+    concurrent listings. The credentials never appear on a command line.
+    '''
+
+    def __init__(self, username=None, password=None):
+        self.username = username
+        self.password = password
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def open(self, url):
+        providers = [
+            svn_core.svn_auth_get_simple_provider(),
+            svn_core.svn_auth_get_username_provider(),
+            svn_core.svn_auth_get_ssl_server_trust_file_provider(),
+            svn_core.svn_auth_get_ssl_server_trust_prompt_provider(trust_server_cert),
+        ]
+
+        auth = svn_core.svn_auth_open(providers)
+        svn_core.svn_auth_set_parameter(auth, svn_core.SVN_AUTH_PARAM_NON_INTERACTIVE, '')
+        if self.username:
+            svn_core.svn_auth_set_parameter(auth, svn_core.SVN_AUTH_PARAM_DEFAULT_USERNAME, self.username)
+        if self.password:
+            svn_core.svn_auth_set_parameter(auth, svn_core.SVN_AUTH_PARAM_DEFAULT_PASSWORD, self.password)
+
+        callbacks = svn_ra.Callbacks()
+        callbacks.auth_baton = auth
+        session = svn_ra.open2(url, callbacks, {})
+        return to_str(svn_ra.get_repos_root(session)), session
+
+    def acquire(self, url):
+        with self.lock:
+            for root, sessions in self.idle.items():
+                if sessions and (url == root or url.startswith(root + '/')):
+                    return root, sessions.pop()
+        return self.open(url)
+
+    def release(self, root, session):
+        with self.lock:
+            self.idle.setdefault(root, []).append(session)
+
+    def call(self, url, func):
+        '''Call func with a session that is parented at url.'''
+
+        url = to_str(svn_core.svn_uri_canonicalize(url))
+        root, session = self.acquire(url)
+        svn_ra.reparent(session, url)
+        res = func(session)
+
+        # Only sessions that did not fail are reused.
+        self.release(root, session)
+        return res
+
+    def ls(self, url, recursive=False):
+        fields = svn_core.SVN_DIRENT_KIND | svn_core.SVN_DIRENT_CREATED_REV | svn_core.SVN_DIRENT_TIME
+
+        def get_dir(session, path=''):
+            dirents = svn_ra.get_dir2(session, path, svn_core.SVN_INVALID_REVNUM, fields)[0]
+            for name, dirent in sorted(dirents.items()):
+                name = to_str(name)
+                if path:
+                    name = path + '/' + name
+                if dirent.kind == svn_core.svn_node_dir:
+                    # Times are in microseconds.
+                    yield name, str(dirent.created_rev), dirent.time // 1000000
+                    if recursive:
+                        for i in get_dir(session, name):
+                            yield i
 
-    if not wcard:
         try:
-            return svn_ls(left, username, password, True)
-        except subprocess.CalledProcessError:
-            return []
-    else:
-        for dirname in svn_ls(left, username, password, True):
-            url = os.path.join(left, dirname, right)
-            res = svn_wildcard_ls(url, repo, username, password, True)
-            rel = url.replace(repo, '')
-            branches.extend(os.path.join(rel, i) for i in res)
-        return branches
+            return self.call(url, lambda session: list(get_dir(session)))
+        except svn_core.SubversionException as error:
+            # Reported like a failed 'svn ls', so that both backends are
+            # handled in the same way.
+            raise subprocess.CalledProcessError(error.apr_err, ['svn', 'ls', url])
+
+    def info(self, urls):
+        res = {}
+        for url in urls:
+            try:
+                dirent = self.call(url, lambda session: svn_ra.stat(session, '', svn_core.SVN_INVALID_REVNUM))
+            except svn_core.SubversionException:
+                continue
+            if dirent is not None:
+                res[url] = str(dirent.created_rev)
+        return res
+
+def trust_server_cert(realm, failures, cert_info, may_save, pool=None):
+    '''Same as --trust-server-cert: accept certificates of an unknown CA.'''
+
+    creds = svn_core.svn_auth_cred_ssl_server_trust_t()
+    creds.may_save = False
+    creds.accepted_failures = failures & svn_core.SVN_AUTH_SSL_UNKNOWNCA
+    return creds
+
+def to_str(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+def get_backend(config):
+    '''Use the Python bindings if they are enabled and installed.'''
+
+    c = config
+    if svn_core is not None and c.get('list-bindings', False):
+        return SvnBindings(c['scm-username'], c['scm-password'])
+    return SvnCli(c['scm-username'], c['scm-password'])
+
+@contextmanager
+def open_store(config):
+    '''
+    Yield the State in which 'svn ls' results are kept between runs, or None.
+    The state of the current run (or of the batch) is reused. A state that
+    is opened here is closed afterwards.
+    '''
+
+    path = config.get('state-file')
+    store = main.states.get(path)
+    if store is None and main.state is not None and main.state.path in (path, ':memory:'):
+        store = main.state
+
+    if store is not None or not path:
+        yield store
+        return
+
+    store = State(path)
+    try:
+        yield store
+    finally:
+        store.close()
+
+class SvnLister(object):
+    '''
+    Lists directories with a backend (SvnCli or SvnBindings), at most jobs
+    at a time. Every url is listed only once. The listing of a url that could not be
+    listed is the exception that was raised.
+
+    If a store (a State) is given, listings are also kept between runs and
+    are keyed by the url and the last changed revision of the directory.
+    Since the last changed revision of a directory changes with every commit
+    below it, an unchanged directory does not need to be listed again. The
+    revisions of the listed directories are looked up with a single 'svn
+    info' and those of their subdirectories are taken from the listings.
+    '''
+
+    def __init__(self, backend, jobs=1, store=None):
+        self.backend = backend
+        self.jobs = jobs
+        self.store = store
+        self.cache = {}
+        self.revisions = {}
+        self.stats = {'listed': 0, 'reused': 0}
+
+    def lookup_revisions(self, urls):
+        urls = [url for url in urls if url not in self.revisions]
+        if self.store is not None and urls:
+            self.revisions.update(self.backend.info(urls))
+
+    def ls(self, url, recursive=False):
+        revision = self.revisions.get(url)
+        if self.store is not None and revision is not None:
+            cached = self.store.get_listing(url, recursive)
+            if cached and cached[0] == revision:
+                return url, cached[1], True
+
+        try:
+            listing = self.backend.ls(url, recursive=recursive)
+        except subprocess.CalledProcessError as error:
+            return url, error, False
+
+        if self.store is not None and revision is not None:
+            self.store.set_listing(url, recursive, revision, listing)
+        return url, listing, False
+
+    def ls_many(self, urls, recursive=False):
+        '''List several urls concurrently and return their listings as a
+           {url: listing} dict.'''
+
+        todo = sorted(set(url for url in urls if (url, recursive) not in self.cache))
+        self.lookup_revisions(todo)
+
+        for url, listing, reused in utils.parallel_map(partial(self.ls, recursive=recursive), todo, self.jobs):
+            self.cache[(url, recursive)] = listing
+            self.stats['reused' if reused else 'listed'] += 1
+
+            # The revisions of the subdirectories of a listed directory.
+            if not recursive and not isinstance(listing, Exception):
+                for name, revision, _ in listing:
+                    self.revisions[url + '/' + name] = revision
+
+        return dict((url, self.cache[(url, recursive)]) for url in urls)
+
+def split_wildcard(url):
+    '''
+    Split a url into the path before its first wildcard and the remaining
+    path components.
+
+    >>> split_wildcard('file:///repo/projects/*/branches/')
+    ('file:///repo/projects', ('*', 'branches'))
+    '''
+
+    parts = url.rstrip('/').split('/')
+    n = next(n for n, part in enumerate(parts) if '*' in part)
+    return '/'.join(parts[:n]), tuple(parts[n:])
+
+def svn_wildcard_dirs(urls, lister):
+    '''
+    Return the directories that each of the wildcard urls matches as a
+    {url: [directory url]} dict. Directories are expanded one level at a
+    time. All directories of a level are listed concurrently and urls with
+    overlapping prefixes share their listings.
+    '''
+
+    res = dict((url, []) for url in urls)
+    level = [(url,) + split_wildcard(url) for url in urls]
+
+    while level:
+        expand = []
+        for url, base, rest in level:
+            # Literal path components do not need to be listed.
+            while rest and '*' not in rest[0]:
+                base, rest = base + '/' + rest[0], rest[1:]
+            if rest:
+                expand.append((url, base, rest))
+            else:
+                res[url].append(base)
+
+        listings = lister.ls_many([base for url, base, rest in expand])
+
+        level = []
+        for url, base, rest in expand:
+            listing = listings[base]
+            if isinstance(listing, Exception):
+                continue
+            for name, _, _ in listing:
+                if fnmatch.fnmatchcase(name, rest[0]):
+                    level.append((url, base + '/' + name, rest[1:]))
+
+    for dirs in res.values():
+        dirs.sort()
+    return res
+
+def svn_wildcard_ls_recursive(urls, lister):
+    '''
+    Same as listing the directories returned by svn_wildcard_dirs(), but
+    with a single recursive listing of every wildcard url prefix. The
+    matching is done client-side. This is cheaper when the wildcards expand
+    to many directories that contain little else than the branches.
+    Returns a {url: [(branch url, revision, time)]} dict.
+    '''
+
+    patterns = dict((url, split_wildcard(url)) for url in urls)
+    bases = set(base for base, rest in patterns.values())
+
+    # The listing of a prefix also covers all prefixes below it.
+    roots = [base for base in bases if not any(base.startswith(i + '/') for i in bases)]
+    listings = lister.ls_many(roots, recursive=True)
+
+    res = {}
+    for url, (base, rest) in patterns.items():
+        root = next(i for i in roots if base == i or base.startswith(i + '/'))
+        pattern = tuple(base[len(root):].split('/')[1:]) + rest
+
+        listing = listings[root]
+        if isinstance(listing, Exception):
+            listing = []
+
+        res[url] = branches = []
+        for path, rev, date in listing:
+            parts = path.rstrip('/').split('/')
+            if len(parts) != len(pattern) + 1:
+                continue
+            if all(fnmatch.fnmatchcase(a, b) for a, b in zip(parts, pattern)):
+                branches.append((root + '/' + '/'.join(parts), rev, date))
+        branches.sort()
+
+    return res
 
 def list_branches(config):
+    '''List all branches as (path, last changed revision) pairs. If
+       'max-age' is set, the last changed time is included as well.'''
+
     c = config
-    branches = []
+    plain = [url for url in c['branches'] if '*' not in url]
+    wildcards = [url for url in c['branches'] if '*' in url]
 
-    for url in c['branches']:
-        if '*' in url:
-            res = svn_wildcard_ls(url, c['repo'], c['scm-username'], c['scm-password'])
-            res = [i.lstrip('/') for i in res]
+    with open_store(c) as store:
+        lister = SvnLister(get_backend(c), c.get('list-jobs', 4), store)
+
+        if c.get('list-recursive', False):
+            found = svn_wildcard_ls_recursive(wildcards, lister)
+            dirs = {}
         else:
-            res = svn_ls(url, c['scm-username'], c['scm-password'])
-            rel = url.replace(c['repo'], '').lstrip('/')
-            res = [os.path.join(rel, i) for i in res]
-        branches.extend(res)
-    return branches
+            found = {}
+            dirs = svn_wildcard_dirs(wildcards, lister)
 
-def create_job(branch, template, config, branch_config):
-    '''Create a jenkins job.
-       :param branch: svn branch name (ex: branches/feature-one)
-       :param template: the config of the template job to use
-       :param config: global config (parsed yaml)
-       :param branch_config: the effective config for this branch
-    '''
+        urls = [url.rstrip('/') for url in plain]
+        urls.extend(i for url in dirs.values() for i in url)
+        listings = lister.ls_many(urls)
 
-    print('\nprocessing branch: %s' % branch)
+    def relative(url, name=''):
+        repo = c['repo'].rstrip('/')
+        rel = url[len(repo):] if url.startswith(repo) else url
+        rel = rel.strip('/')
+        return '/'.join(i for i in (rel, name) if i)
+
+    branches = []
+    for url in c['branches']:
+        if url in found:
+            branches.extend((relative(i), rev, date) for i, rev, date in found[url])
+            continue
 
-    # Job names with '/' in them are problematic.
-    sanitized_branch = branch.replace('/', branch_config['namesep'])
+        for dirname in dirs.get(url, [url.rstrip('/')]):
+            listing = listings[dirname]
+            if isinstance(listing, Exception):
+                # Errors are only fatal for urls without wildcards.
+                if url in dirs:
+                    continue
+                raise listing
+            branches.extend((relative(dirname, name), rev, date) for name, rev, date in listing)
+
+    if c.get('max-age') is None:
+        return [i[:2] for i in branches]
+    return branches
+
+def get_fmtdict(branch, config, branch_config):
+    '''Return the placeholders available to the 'substitute' and 'namefmt'
+       options as (groups, groupdict, fmtdict).'''
 
     match = branch_config['re'].match(branch)
     groups, groupdict = match.groups(), match.groupdict()
 
-    # Placeholders available to the 'substitute' and 'namefmt' options.
     fmtdict = {
         'branch': branch.split('/')[-1],
         'path': branch.replace('/', branch_config['namesep']),
@@ -90,8 +492,28 @@ def create_job(branch, template, config, branch_config):
         'repo-orig': config['repo'],
     }
 
+    return groups, groupdict, fmtdict
+
+def get_job_name(branch, config, branch_config):
+    '''Return the name of the job for a branch.'''
+    groups, groupdict, fmtdict = get_fmtdict(branch, config, branch_config)
+    return branch_config['namefmt'].format(*groups, **utils.merge(groupdict, fmtdict))
+
+def create_job(branch, template, config, branch_config):
+    '''Create a jenkins job.
+       :param branch: svn branch name (ex: branches/feature-one)
+       :param template: the template job to use (job.Template)
+       :param config: global config (parsed yaml)
+       :param branch_config: the effective config for this branch
+    '''
+
+    print('\nprocessing branch: %s' % branch)
+
+    # Placeholders available to the 'substitute' and 'namefmt' options.
+    groups, groupdict, fmtdict = get_fmtdict(branch, config, branch_config)
+
     job_name = branch_config['namefmt'].format(*groups, **utils.merge(groupdict, fmtdict))
-    job_obj = job.Job(job_name, branch, template, main.jenkins)
+    job_obj = job.Job(job_name, branch, template, main.jenkins, main.inventory)
 
     fmtdict['job_name'] = job_name
 
@@ -99,18 +521,18 @@ def create_job(branch, template, config, branch_config):
     print('. job exists: %s' % job_obj.exists)
 
     try:
-        scm_el = job_obj.xml.xpath('scm[@class="hudson.scm.SubversionSCM"]')[0]
+        template.xpath('scm[@class="hudson.scm.SubversionSCM"]')[0]
     except IndexError:
         msg = 'Template job %s is not configured to use SVN as an SCM'
-        raise RuntimeError(msg % template)  # :bug:
+        raise RuntimeError(msg % template.name)
 
     # set branch
-    el = scm_el.xpath('//remote')[0]
-    el.text = os.path.join(config['repo'], branch)
+    el = template.xpath('//remote')[0]
+    job_obj.set_text(el, os.path.join(config['repo'], branch))
 
     # Set the branch that git plugin will locally checkout to.
-    el = scm_el.xpath('//local')[0]
-    el.text = '.'
+    el = template.xpath('//local')[0]
+    job_obj.set_text(el, '.')
 
     # Set the state of the newly created job.
     job_obj.set_state(branch_config['enable'])
@@ -132,7 +554,8 @@ def create_job(branch, template, config, branch_config):
     return job_name
 
 def _main(argv=sys.argv, config=None):
-    main.main(argv[1:], config=config, create_job=create_job, list_branches=list_branches)
+    main.main(argv[1:], config=config, create_job=create_job, list_branches=list_branches,
+              get_job_name=get_job_name)
 
 if __name__ == '__main__':
     _main()
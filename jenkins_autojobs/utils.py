@@ -1,9 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8; -*-
 
-import re, copy
+import re, sys, copy
+import threading
 import subprocess as sub
 
+from contextlib import contextmanager
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 
 #-----------------------------------------------------------------------------
 def filtersplit(p, iterable):
@@ -41,6 +51,120 @@ def anymatch(regexes, s):
             return True
     return False
 
+#-----------------------------------------------------------------------------
+class RefMatcher(object):
+    '''
+    Find the first of a list of (regex, value) pairs whose regex matches a
+    string. This is the same as trying the regexes in order, but the literal
+    prefixes of the regexes are kept in a trie, so that only regexes that
+    can possibly match are considered, and the candidates are combined into
+    a single alternation, so that one regex call finds the first match.
+
+    >>> pairs = [(re.compile(i), i) for i in ('refs/tags/.*', 'refs/heads/(.*)', '.*')]
+    >>> matcher = RefMatcher(pairs)
+    >>> matcher.match('refs/heads/master')[1]
+    'refs/heads/(.*)'
+    >>> matcher.match('refs/remotes/origin/master')[1]
+    '.*'
+    '''
+
+    # Patterns with backreferences can't be moved into an alternation.
+    unsafe = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+    def __init__(self, pairs):
+        self.pairs = list(pairs)
+        self.trie = {}
+        self.combined = {}
+
+        for n, (regex, value) in enumerate(self.pairs):
+            node = self.trie
+            for char in literal_prefix(regex.pattern):
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(n)
+
+    def candidates(self, s):
+        '''Return the indices of the regexes that may match s.'''
+        node, res = self.trie, []
+        for char in s:
+            res.extend(node.get(None, ()))
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            res.extend(node.get(None, ()))
+        return tuple(sorted(res))
+
+    def compile(self, candidates):
+        '''Combine regexes into an alternation of named groups. Return None if
+           that is not possible and the regexes have to be tried in order.'''
+        patterns = [self.pairs[n][0] for n in candidates]
+        if any(self.unsafe.search(r.pattern) or r.flags & ~re.UNICODE != 0 for r in patterns):
+            return None
+
+        pattern = '|'.join('(?P<_m%d>%s)' % (n, self.pairs[n][0].pattern) for n in candidates)
+        try:
+            return re.compile(pattern)
+        except (re.error, AssertionError):
+            return None
+
+    def match(self, s):
+        '''Return the first (regex, value) pair whose regex matches s or None.'''
+        candidates = self.candidates(s)
+        if not candidates:
+            return None
+
+        try:
+            combined = self.combined[candidates]
+        except KeyError:
+            combined = self.combined.setdefault(candidates, self.compile(candidates))
+
+        if combined is None:
+            for n in candidates:
+                if self.pairs[n][0].match(s):
+                    return self.pairs[n]
+            return None
+
+        match = combined.match(s)
+        if match:
+            return self.pairs[int(match.lastgroup[2:])]
+
+def literal_prefix(pattern):
+    '''
+    Return the literal text that every match of a regex starts with.
+
+    >>> literal_prefix('refs/heads/feature-(.*)')
+    'refs/heads/feature-'
+    >>> literal_prefix('refs/tags/v1\\.2?')
+    'refs/tags/v1.'
+    >>> literal_prefix('refs/(heads|tags)/.*|x')
+    ''
+    '''
+    if '|' in pattern:
+        return ''
+
+    res, i = [], 0
+    if pattern.startswith('^'):
+        i = 1
+
+    while i < len(pattern):
+        char, step = pattern[i], 1
+        if char == '\\':
+            char, step = pattern[i+1:i+2], 2
+            if not char or char.isalnum():
+                break
+        elif char in '.^$*+?{}[]()':
+            break
+
+        quantifier = pattern[i+step:i+step+1]
+        if quantifier in ('*', '?', '{'):
+            break
+        res.append(char)
+        if quantifier == '+':
+            break
+        i += step
+
+    return ''.join(res)
+
 #-----------------------------------------------------------------------------
 def sanitize(ref, rules):
     '''
@@ -55,14 +179,118 @@ def sanitize(ref, rules):
     >>> sanitize('develop#test/zxcv@ASDF&1', rules)
     'dev_test-zxcvXASDF_1'
     '''
-    for pattern, value in rules.items():
-        if pattern.startswith('re:'):
-            pattern = pattern.lstrip('re:')
-        else:
-            pattern = '|'.join(map(re.escape, pattern))
-        ref = re.sub(pattern, value, ref)
+    if not isinstance(rules, Sanitizer):
+        rules = Sanitizer(rules)
+    return rules(ref)
+
+class Sanitizer(object):
+    '''
+    Sanitize rules compiled into a callable. Rules are applied in order.
+    Consecutive character rules are merged into a single translation table
+    and regex rules (prefixed with 're:') are compiled once. Results are
+    cached, since the same strings (the repo url for example) are
+    sanitized for every ref.
+
+    >>> sanitizer = Sanitizer({'/': '-', '-': '_', 're:^x': 'y'})
+    >>> sanitizer('x/a-b')
+    'y_a_b'
+    '''
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.steps = []
+        self.cache = {}
+
+        table = None
+        for pattern, value in rules.items():
+            repl = None
+            if not pattern.startswith('re:'):
+                repl = _expand_template(value)
+
+            if repl is None or not pattern:
+                if pattern.startswith('re:'):
+                    pattern = pattern.lstrip('re:')
+                else:
+                    pattern = '|'.join(map(re.escape, pattern))
+                self.steps.append((re.compile(pattern), value))
+                table = None
+                continue
+
+            # Applying this rule after the table is the same as applying the
+            # rule to the table's replacements.
+            if table is None:
+                table = {}
+                self.steps.append(table)
+            rule = dict((ord(char), repl) for char in pattern)
+            for char, prev in table.items():
+                table[char] = _translate(prev, rule)
+            for char in rule:
+                table.setdefault(char, repl)
+
+    def __call__(self, ref):
+        try:
+            return self.cache[ref]
+        except KeyError:
+            pass
+
+        res = ref
+        for step in self.steps:
+            if isinstance(step, dict):
+                res = _translate(res, step)
+            else:
+                res = step[0].sub(step[1], res)
+
+        self.cache[ref] = res
+        return res
+
+    def __repr__(self):
+        return 'Sanitizer(%r)' % (self.rules,)
+
+def _expand_template(value):
+    '''Return a replacement string as re.sub() would insert it or None if
+       it refers to groups (or is invalid).'''
+    try:
+        res = re.sub('x', value, 'x')
+        if res == re.sub('y', value, 'y'):
+            return res
+    except (re.error, IndexError):
+        pass
+
+def _translate(s, table):
+    try:
+        return s.translate(table)
+    except TypeError:
+        # Byte strings on Python 2.
+        return ''.join(table.get(ord(c), c) for c in s)
+
+#-----------------------------------------------------------------------------
+def parallel_map(func, iterable, jobs=1):
+    '''
+    Lazily map func over iterable using a pool of at most jobs threads.
+    Results are yielded in order. The iterable is consumed on the caller's
+    thread and at most 2 * jobs items are taken from it ahead of the
+    results, so that calls can be chained into a pipeline.
 
-    return ref
+    >>> list(parallel_map(abs, [-1, -2, 3], jobs=2))
+    [1, 2, 3]
+    '''
+
+    if jobs <= 1:
+        for i in iterable:
+            yield func(i)
+        return
+
+    pool = ThreadPool(jobs)
+    pending = deque()
+    try:
+        for i in iterable:
+            pending.append(pool.apply_async(func, (i,)))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
 
 #-----------------------------------------------------------------------------
 def merge(a, b):
@@ -87,6 +315,147 @@ def check_output(*popenargs, **kwargs):
         raise error
     return output
 
+def iter_output(cmd, **kwargs):
+    '''
+    Run a command and yield the lines of its output (decoded, without the
+    line ending) as they are produced. Raises CalledProcessError if the
+    command fails.
+
+    >>> list(iter_output(['printf', 'one\\ntwo\\n']))
+    ['one', 'two']
+    '''
+
+    process = sub.Popen(cmd, stdout=sub.PIPE, **kwargs)
+    finished = False
+    try:
+        for line in iter(process.stdout.readline, b''):
+            yield line.decode('utf8').rstrip('\r\n')
+        finished = True
+    finally:
+        process.stdout.close()
+        if not finished:
+            process.kill()
+        retcode = process.wait()
+
+    if retcode:
+        raise sub.CalledProcessError(retcode, cmd)
+
+#-----------------------------------------------------------------------------
+class ThreadLocalOutput(object):
+    '''
+    A file-like object that sends writes from threads that are currently
+    capturing to a buffer of their own and everything else to the wrapped
+    stream. Worker threads use this to keep their output from interleaving.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        buf = getattr(self.local, 'buffer', None)
+        (self.stream if buf is None else buf).write(data)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @contextmanager
+    def capture(self):
+        self.local.buffer = buf = StringIO()
+        try:
+            yield buf
+        finally:
+            self.local.buffer = None
+
+#-----------------------------------------------------------------------------
+class Counter(object):
+    '''A counter that can be incremented from several threads.'''
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def increment(self, n=1):
+        with self.lock:
+            self.value += n
+            return self.value
+
+#-----------------------------------------------------------------------------
+def chunked(iterable, size):
+    '''
+    Split an iterable into lists of at most size items (lazily).
+
+    >>> list(chunked(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    '''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+@contextmanager
+def open_input(path):
+    '''Open a file for reading and close it when done. Yields stdin for '-'
+       (which is left open) and None if path is empty.'''
+    if not path:
+        yield None
+    elif path == '-':
+        yield sys.stdin
+    else:
+        with open(path) as fh:
+            yield fh
+
+def read_refs(lines):
+    '''
+    Parse ref names or 'old new ref' lines (the input of a git post-receive
+    hook) into (ref, deleted) pairs. Blank lines and comments are skipped.
+
+    >>> zero = '0' * 40
+    >>> list(read_refs(['refs/heads/one\\n', '# comment', '%s abc123 refs/heads/two' % zero,
+    ...                 'abc123 %s refs/heads/three' % zero]))
+    [('refs/heads/one', False), ('refs/heads/two', False), ('refs/heads/three', True)]
+    '''
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        match = re.match(r'([0-9a-f]+) ([0-9a-f]+) (.+)$', line)
+        if match:
+            old, new, ref = match.groups()
+            yield ref, not new.strip('0')
+        else:
+            yield line, False
+
+#-----------------------------------------------------------------------------
+def parse_duration(value):
+    '''
+    Convert a duration such as '30d', '12h' or '2w' to seconds. Plain
+    numbers are taken to be seconds.
+
+    >>> parse_duration('30d'), parse_duration('1.5h'), parse_duration(90)
+    (2592000, 5400, 90)
+    '''
+
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+    value = str(value).strip()
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([smhdw]?)$', value)
+    if not match:
+        raise ValueError('invalid duration: %r' % value)
+
+    number, unit = match.groups()
+    return int(float(number) * units[unit or 's'])
+
+#-----------------------------------------------------------------------------
 def PromptArgtype(func, args):
     def validator(value):
         if value != '-':
@@ -0,0 +1,218 @@
+# -*- coding: utf-8; -*-
+
+'''
+An embedded HTTP endpoint that reconciles refs as soon as they are pushed.
+
+Push events are POSTed as a JSON object with the repository url, the ref
+name and whether the ref was deleted:
+
+  {"repo": "git@github.com:foo/bar.git", "ref": "refs/heads/feature", "deleted": false}
+
+Events are queued and processed by a single worker thread. Events for a ref
+that is already queued replace the queued event, which coalesces bursts of
+pushes to the same ref. Queue statistics are available at GET /stats.
+
+The receiver listens on localhost unless another host is given. If a
+'webhook-secret' is configured, events must carry it in the X-Autojobs-Secret
+header.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hmac
+import json
+import time
+import threading
+import traceback
+
+from . import main
+
+
+#-----------------------------------------------------------------------------
+# Compatibility imports.
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+#-----------------------------------------------------------------------------
+class EventQueue(object):
+    '''A queue of (repo, ref) -> deleted events with at most one event per ref.'''
+
+    def __init__(self):
+        self.events = OrderedDict()
+        self.cond = threading.Condition()
+        self.stats = {'received': 0, 'coalesced': 0, 'processed': 0, 'failed': 0}
+
+    def __len__(self):
+        with self.cond:
+            return len(self.events)
+
+    def put(self, repo, ref, deleted):
+        with self.cond:
+            self.stats['received'] += 1
+            if (repo, ref) in self.events:
+                self.stats['coalesced'] += 1
+            self.events[(repo, ref)] = deleted
+            self.cond.notify()
+
+    def get_all(self, delay=0.25):
+        '''Wait for events and return all of them as ((repo, ref), deleted)
+           pairs. Events that arrive within delay seconds of the first one
+           are returned together.'''
+
+        with self.cond:
+            while not self.events:
+                self.cond.wait()
+
+            # Every put() wakes us up, so wait until the delay is over.
+            deadline = time.time() + delay
+            remaining = delay
+            while remaining > 0:
+                self.cond.wait(remaining)
+                remaining = deadline - time.time()
+
+            events, self.events = self.events, OrderedDict()
+        return list(events.items())
+
+    def get_stats(self):
+        with self.cond:
+            stats = dict(self.stats)
+            stats['queue-depth'] = len(self.events)
+        return stats
+
+    def done(self, failed=False):
+        with self.cond:
+            self.stats['failed' if failed else 'processed'] += 1
+
+
+#-----------------------------------------------------------------------------
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') != '/stats':
+            return self.reply(404, {'error': 'not found'})
+        self.reply(200, self.server.receiver.queue.get_stats())
+
+    def do_POST(self):
+        secret = self.server.receiver.config.get('webhook-secret')
+        if secret and not compare_digest(self.headers.get('X-Autojobs-Secret') or '', str(secret)):
+            return self.reply(403, {'error': 'missing or wrong X-Autojobs-Secret header'})
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            event = json.loads(self.rfile.read(length).decode('utf8'))
+            repo, ref = event['repo'], event['ref']
+            deleted = bool(event.get('deleted', False))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self.reply(400, {'error': 'expected {"repo": ..., "ref": ..., "deleted": ...}'})
+
+        queue = self.server.receiver.queue
+        queue.put(repo, ref, deleted)
+        self.reply(202, {'queue-depth': len(queue)})
+
+    def reply(self, code, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class Receiver(object):
+    '''
+    Accept push events on address and reconcile the refs they refer to. The
+    config can be replaced while the receiver is running (the templates dict
+    is shared with the caller and updated in place).
+    '''
+
+    def __init__(self, address, config, templates, create_job, get_job_name):
+        self.config = config
+        self.templates = templates
+        self.create_job = create_job
+        self.get_job_name = get_job_name
+        self.queue = EventQueue()
+
+        self.server = HTTPServer(address, Handler)
+        self.server.receiver = self
+
+    def start(self):
+        host, port = self.server.server_address[:2]
+        print('\nlistening for push events on http://%s:%s/' % (host, port))
+
+        for target in self.server.serve_forever, self.work:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def work(self):
+        while True:
+            events = self.queue.get_all()
+            with main.lock:
+                for n, ((repo, ref), deleted) in enumerate(events):
+                    try:
+                        # Jobs may have changed since the last events or poll.
+                        if n == 0:
+                            main.inventory.refresh()
+                        self.handle(repo, ref, deleted)
+                        self.queue.done()
+                    except Exception:
+                        traceback.print_exc()
+                        self.queue.done(failed=True)
+
+    def handle(self, repo, ref, deleted):
+        config = self.config
+
+        if repo.rstrip('/') != config['repo'].rstrip('/'):
+            print('\nignoring push event for unknown repository: %s' % repo)
+            return
+
+        ignored, configs = main.classify_refs(config, [ref])
+        if not configs:
+            print('\nignoring push event for %s: %s' % ('ignored ref' if ignored else 'unmatched ref', ref))
+            return
+
+        branch, branch_config = configs[0]
+        if deleted:
+            main.remove_ref_jobs(config, [(branch, branch_config)], self.get_job_name)
+        else:
+            main.process_branch(self.create_job, self.templates, config, branch, branch_config)
+            pending_views = main.inventory.pop_pending_views()
+            if pending_views:
+                main.add_pending_view_jobs(config, pending_views)
+
+
+def parse_address(value):
+    '''
+    Parse a '[host:]port' address. The host defaults to localhost. An empty
+    host (':port') listens on all interfaces.
+
+    >>> parse_address('8080')
+    ('127.0.0.1', 8080)
+    >>> parse_address('0.0.0.0:8080')
+    ('0.0.0.0', 8080)
+    >>> parse_address(':8080')
+    ('', 8080)
+    '''
+    host, sep, port = str(value).rpartition(':')
+    return (host if sep else '127.0.0.1'), int(port)
+
+def compare_digest(a, b):
+    '''Compare two strings in constant time (where supported).'''
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a.encode('utf8'), b.encode('utf8'))
+    return a == b
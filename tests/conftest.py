@@ -1,9 +1,13 @@
 # -*- coding: utf-8; -*-
 
+import re
 import pytest
+import lxml.etree
 
 from os import chdir
 from os.path import abspath, dirname, join
+from collections import OrderedDict
+from requests.exceptions import HTTPError
 
 
 #-----------------------------------------------------------------------------
@@ -16,3 +20,177 @@ def pytest_runtest_setup(item):
     chdir(join(here, 'etc'))
     if 'slow' in item.keywords and not item.config.getoption('--runslow'):
         pytest.skip('need --runslow option to run')
+
+#-----------------------------------------------------------------------------
+# Stand-ins for the jenkins and inventory objects in unit tests that do not
+# need a running Jenkins. Every request to the stub jenkins is recorded in
+# server.requests as 'METHOD path'.
+def to_str(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+class StubResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+class StubServer(object):
+    def __init__(self, jenkins):
+        self.jenkins = jenkins
+        self.requests = []
+
+    def json(self, url, errmsg=None):
+        self.requests.append('GET ' + url)
+        return self.jenkins.respond(url)
+
+class StubJob(object):
+    def __init__(self, jenkins, name):
+        self.jenkins, self.server, self.name = jenkins, jenkins.server, name
+
+    def __eq__(self, other):
+        return self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def url(self, path=''):
+        return 'job/%s/%s' % (self.name, path)
+
+    @property
+    def exists(self):
+        self.server.requests.append('GET ' + self.url('api/json'))
+        return self.name in self.jenkins.configs
+
+    @property
+    def config(self):
+        self.server.requests.append('GET ' + self.url('config.xml'))
+        config = self.jenkins.configs[self.name]
+        if config is None:
+            raise HTTPError(response=StubResponse(403))
+        return config
+
+    @config.setter
+    def config(self, config):
+        self.server.requests.append('POST ' + self.url('config.xml'))
+        self.jenkins.set_config(self.name, config)
+
+    def delete(self):
+        self.server.requests.append('POST ' + self.url('doDelete'))
+        del self.jenkins.configs[self.name]
+
+class StubView(object):
+    def __init__(self, jenkins, name):
+        self.jenkins, self.server, self.name = jenkins, jenkins.server, name
+
+    @property
+    def exists(self):
+        self.server.requests.append('GET view/%s/api/json' % self.name)
+        return self.name in self.jenkins.views
+
+    @property
+    def config(self):
+        self.server.requests.append('GET view/%s/config.xml' % self.name)
+        return self.jenkins.views[self.name]
+
+    @config.setter
+    def config(self, config):
+        self.server.requests.append('POST view/%s/config.xml' % self.name)
+        self.jenkins.views[self.name] = to_str(config)
+
+    @property
+    def config_etree(self):
+        return lxml.etree.fromstring(self.config.encode('utf8'))
+
+class StubJenkins(object):
+    '''
+    Jobs and views are kept as {name: config.xml} dicts (the config of a job
+    that cannot be read is None) and the descriptions of jobs in a dict.
+    '''
+
+    def __init__(self):
+        self.configs = OrderedDict()
+        self.descriptions = {}
+        self.views = OrderedDict()
+        self.server = StubServer(self)
+
+    def add_job(self, name, config='<project/>', description=''):
+        self.configs[name] = config
+        self.descriptions[name] = description
+
+    def add_view(self, name, *job_names):
+        strings = ''.join('<string>%s</string>' % i for i in job_names)
+        self.views[name] = '<hudson.model.ListView><jobNames>%s</jobNames></hudson.model.ListView>' % strings
+
+    def set_config(self, name, config):
+        config = self.configs[name] = to_str(config)
+        self.descriptions[name] = lxml.etree.fromstring(config.encode('utf8')).findtext('description') or ''
+
+    def requests(self, pattern=''):
+        return [i for i in self.server.requests if re.search(pattern, i)]
+
+    @property
+    def jobs(self):
+        self.server.requests.append('GET api/json?tree=jobs[name]')
+        return [self.job(name) for name in self.configs]
+
+    def job(self, name):
+        return StubJob(self, name)
+
+    def view(self, name):
+        return StubView(self, name)
+
+    def view_jobs(self, name):
+        xml = lxml.etree.fromstring(self.views[name].encode('utf8'))
+        return [self.job(i) for i in xml.xpath('jobNames/string/text()')]
+
+    def view_add_job(self, name, job_name):
+        self.server.requests.append('POST view/%s/addJobToView?name=%s' % (name, job_name))
+        xml = lxml.etree.fromstring(self.views[name].encode('utf8'))
+        lxml.etree.SubElement(xml.find('jobNames'), 'string').text = job_name
+        self.views[name] = to_str(lxml.etree.tostring(xml))
+
+    def job_create(self, name, config):
+        self.server.requests.append('POST createItem?name=%s' % name)
+        self.set_config(name, config)
+
+    def job_build(self, name):
+        self.server.requests.append('POST job/%s/build' % name)
+
+    def respond(self, url):
+        if url == 'api/json?tree=jobs[name],views[name]':
+            return {'jobs': [{'name': i} for i in self.configs],
+                    'views': [{'name': i} for i in self.views]}
+
+        match = re.match(r'api/json\?tree=jobs\[name,description\]\{(\d+),(\d+)\}$', url)
+        if match:
+            start, end = map(int, match.groups())
+            jobs = [{'name': i, 'description': self.descriptions.get(i)} for i in self.configs]
+            return {'jobs': jobs[start:end]}
+
+        match = re.match(r'job/([^/]+)/api/json\?tree=description$', url)
+        if match:
+            return {'description': self.descriptions.get(match.group(1))}
+
+        raise ValueError('unexpected request: %s' % url)
+
+class StubInventory(object):
+    def __init__(self):
+        self.jobs = set()
+
+    def job_exists(self, name):
+        return name in self.jobs
+
+    def add_job(self, name):
+        self.jobs.add(name)
+
+    def remove_job(self, name):
+        self.jobs.discard(name)
+
+    def refresh(self):
+        pass
+
+@pytest.fixture
+def stub_jenkins():
+    return StubJenkins()
+
+@pytest.fixture
+def stub_inventory():
+    return StubInventory()
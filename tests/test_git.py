@@ -1,6 +1,6 @@
 # -*- coding: utf-8; -*-
 
-import time, copy
+import re, time, copy
 import io, pytest
 import ruamel.yaml as yaml
 
@@ -8,6 +8,7 @@ from pytest import mark
 from pytest import fixture, yield_fixture
 from textwrap import dedent
 from functools import partial
+from collections import OrderedDict
 
 from repo_fixture import repo_fixture
 from utils import is_created_by_jenkinsautojobs
@@ -82,7 +83,12 @@ def config(jenkins, repo):
     return base
 
 @fixture(scope='function', autouse=True)
-def cleanup(request, jenkins):
+def cleanup(request):
+    # Unit tests that do not use jenkins do not need a running instance.
+    if 'jenkins' not in request.fixturenames:
+        return
+    jenkins = request.getfixturevalue('jenkins')
+
     def finalize():
         jobs = (job for job in jenkins.jobs if job.name != 'master-job-git')
         for job in jobs:
@@ -555,3 +561,46 @@ def test_build_on_create(config, jenkins, repo):
         cmd(config)
         time.sleep(10)
         assert len(jenkins.job('feature-one').builds) == 1
+
+
+#-----------------------------------------------------------------------------
+def test_ref_prefixes():
+    refs = lambda *patterns: {'refs': OrderedDict((re.compile(i), {}) for i in patterns)}
+
+    res = git.get_ref_prefixes(refs('refs/heads/feature-(.*)', 'refs/heads/feature-x/.*', 'refs/tags/v1\\..*'))
+    assert res == ('refs/heads/feature-', 'refs/tags/v1.')
+
+    assert git.get_ref_prefixes(refs('refs/heads/.*', '.*')) is None
+    assert git.get_ref_prefixes(refs('refs/(heads|tags)/.*')) is None
+    assert git.get_ls_remote_pattern('refs/heads/a*b?') == 'refs/heads/a\\*b\\?*'
+
+def test_read_refs(tmpdir):
+    sha = lambda c: c * 40
+
+    gitdir = tmpdir.mkdir('.git')
+    gitdir.join('HEAD').write('ref: refs/heads/master\n')
+    gitdir.join('packed-refs').write('\n'.join([
+        '# pack-refs with: peeled fully-peeled sorted ',
+        '%s refs/heads/master' % sha('a'),
+        '%s refs/heads/stale' % sha('a'),
+        '%s refs/tags/v1' % sha('b'),
+        '^%s' % sha('c'),
+    ]) + '\n')
+
+    gitdir.ensure('refs/heads/stale').write(sha('d') + '\n')
+    gitdir.ensure('refs/heads/feature/x').write(sha('e') + '\n')
+    gitdir.ensure('refs/heads/feature/x.lock').write(sha('f') + '\n')
+    gitdir.ensure('refs/remotes/origin/HEAD').write('ref: refs/heads/master\n')
+    gitdir.ensure('refs/remotes/origin/dangling').write('ref: refs/heads/missing\n')
+
+    assert git.find_git_dirs(str(tmpdir)) == (str(gitdir), str(gitdir))
+    assert list(git.git_refs_iter_local(str(tmpdir))) == [
+        ('refs/heads/feature/x', sha('e')),
+        ('refs/heads/master', sha('a')),
+        ('refs/heads/stale', sha('d')),
+        ('refs/remotes/origin/HEAD', sha('a')),
+        ('refs/tags/v1', sha('b')),
+    ]
+
+    res = git.read_refs(str(gitdir), str(gitdir), ('refs/heads/feature/', 'refs/tags/'))
+    assert res == {'refs/heads/feature/x': sha('e'), 'refs/tags/v1': sha('b')}
@@ -1,6 +1,6 @@
 # -*- coding: utf-8; -*-
 
-import io, os, pytest
+import io, os, sys, struct, pytest, subprocess
 import ruamel.yaml as yaml
 
 from pytest import mark
@@ -9,7 +9,7 @@ from textwrap import dedent
 from functools import partial
 
 from repo_fixture import repo_fixture
-from jenkins_autojobs import hg
+from jenkins_autojobs import hg, utils
 from jenkins import Jenkins
 from utils import is_created_by_jenkinsautojobs
 
@@ -69,8 +69,36 @@ def config(jenkins, repo):
     base = yaml.load(io.StringIO(base))
     return base
 
+@fixture
+def fake_mercurial(tmpdir, monkeypatch):
+    '''A mercurial package that the helper imports instead of the real one.'''
+
+    pkg = tmpdir.mkdir('mercurial')
+    pkg.join('__init__.py').write('')
+    pkg.join('ui.py').write('class ui(object): pass\n')
+    pkg.join('node.py').write('import binascii\ndef short(n): return binascii.hexlify(n[:6])\n')
+    pkg.join('hg.py').write(dedent('''\
+    import threading
+    class peer(object):
+        def __init__(self, ui, opts, path):
+            if b'missing' in path:
+                raise Exception('repository not found')
+            self.thread = threading.current_thread()
+        def branchmap(self):
+            assert self.thread is threading.current_thread()
+            return {b'default': [b'\\1' * 20], b'stable': [b'\\2' * 20, b'\\3' * 20]}
+    '''))
+
+    monkeypatch.setenv('PYTHONPATH', str(tmpdir))
+    return str(tmpdir)
+
 @fixture(scope='function', autouse=True)
-def cleanup(request, jenkins):
+def cleanup(request):
+    # Unit tests that do not use jenkins do not need a running instance.
+    if 'jenkins' not in request.fixturenames:
+        return
+    jenkins = request.getfixturevalue('jenkins')
+
     def finalize():
         jobs = (job for job in jenkins.jobs if job.name != 'master-job-hg')
         for job in jobs:
@@ -179,3 +207,84 @@ def test_list_closed(config, jenkins, repo):
         config['list-closed'] = True
         cmd(config)
         assert jenkins.job_exists('branches-two')
+
+#-----------------------------------------------------------------------------
+branches = [('default', '01' * 6), ('stable', '02' * 6)]
+
+def test_helper_process(fake_mercurial):
+    helper = hg.HgHelper(sys.executable)
+    assert helper.query('https://hg.example.org/one') == branches
+
+    # Errors are reported per request and the process is kept running.
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        helper.query('https://hg.example.org/missing')
+    assert 'repository not found' in error.value.output
+    assert error.value.cmd == [sys.executable, hg.hg_remote_helper_path]
+
+    process = helper.process
+    assert helper.query('https://hg.example.org/two') == branches
+    assert helper.process is process
+    process.kill()
+    process.wait()
+
+def test_helper_inprocess(fake_mercurial, monkeypatch):
+    monkeypatch.syspath_prepend(fake_mercurial)
+    monkeypatch.setattr(hg, 'inprocess_helper', None)
+    for name in ('mercurial', 'mercurial.hg', 'mercurial.ui', 'mercurial.node', 'jenkins_autojobs.hg_remote_helper'):
+        monkeypatch.delitem(sys.modules, name, raising=False)
+
+    # Peers are opened once per thread.
+    repos = ['https://hg.example.org/one'] * 8
+    res = list(utils.parallel_map(lambda repo: hg.hg_branch_iter_remote(repo, None), repos, jobs=4))
+    assert res == [branches] * 8
+
+    # Other interpreters are run in a helper process.
+    assert hg.is_current_python(None)
+    assert hg.is_current_python(sys.executable)
+    assert not hg.is_current_python('/nonexistent/python2')
+    assert hg.get_inprocess_helper('/nonexistent/python2') is None
+
+def test_read_branch_cache(tmpdir):
+    def entry(n, length=0, header=0):
+        offset = struct.pack('>I', header) + b'\0' * 4 if n == 0 else b'\0' * 8
+        return offset + struct.pack('>iiiiii', length, length, n, n, n - 1, -1) + bytes(bytearray([n])) * 20 + b'\0' * 12
+
+    hgdir = tmpdir.mkdir('.hg')
+    changelog = hgdir.mkdir('store').join('00changelog.i')
+    changelog.write_binary(b''.join(entry(n, header=1 if n == 0 else 0) for n in range(3)))
+    assert hg.read_changelog_tip(str(changelog)) == ('02' * 20, 2)
+
+    # Inline revlogs have the revision data after every entry.
+    inline = tmpdir.join('inline.i')
+    inline.write_binary(b''.join(entry(n, 5, header=(1 << 16) | 1 if n == 0 else 0) + b'x' * 5 for n in range(3)))
+    assert hg.read_changelog_tip(str(inline)) == ('02' * 20, 2)
+
+    cache = hgdir.mkdir('cache').join('branch2-served')
+    cache.write('\n'.join([
+        '%s 2' % ('02' * 20),
+        '%s o default' % ('00' * 20),
+        '%s o with space' % ('01' * 20),
+        '%s c with space' % ('02' * 20),
+        '%s c old' % ('03' * 20),
+    ]) + '\n')
+
+    assert hg.read_branch_cache(str(hgdir)) == [
+        ('default', '00' * 6, False),
+        ('with space', '01' * 6, False),
+        ('old', '03' * 6, True),
+    ]
+
+    # The cache is not used if it is behind the tip or if it leaves out revisions.
+    cache.write('%s 1\n' % ('01' * 20))
+    assert hg.read_branch_cache(str(hgdir)) is None
+    cache.write('%s 2 %s\n' % ('02' * 20, 'ab' * 20))
+    assert hg.read_branch_cache(str(hgdir)) is None
+
+def test_branches_json(monkeypatch):
+    def iter_output(cmd):
+        assert cmd[-2:] == ['-R', 'repo'] and '{dict(branch, node, closed)|json}\\n' in cmd
+        yield '{"branch": "default", "closed": false, "node": "%s"}' % ('ab' * 20)
+        yield '{"branch": "with space", "closed": true, "node": "%s"}' % ('cd' * 20)
+
+    monkeypatch.setattr(hg.utils, 'iter_output', iter_output)
+    assert list(hg.hg_branches_json('repo')) == [('default', 'ab' * 6, False), ('with space', 'cd' * 6, True)]
@@ -1,6 +1,9 @@
 # -*- coding: utf-8; -*-
 
 import io, os, pytest
+import sqlite3
+import subprocess
+import lxml.etree
 import ruamel.yaml as yaml
 
 from pytest import mark
@@ -10,6 +13,7 @@ from functools import partial
 
 from repo_fixture import repo_fixture
 from jenkins_autojobs import svn
+from jenkins_autojobs.state import State
 from jenkins import Jenkins
 from utils import is_created_by_jenkinsautojobs
 
@@ -81,8 +85,36 @@ def config(jenkins, repo):
     base = yaml.load(io.StringIO(base))
     return base
 
+@fixture
+def svn_tree(monkeypatch):
+    '''
+    Replace 'svn ls' with a listing of a {directory: [subdirectories]} dict.
+    The urls that were listed are appended to svn_tree.calls.
+    '''
+
+    class svn_tree(dict):
+        calls = []
+
+        def ls(self, url, username=None, password=None, dirsonly=True, recursive=False):
+            self.calls.append(url)
+            if url not in self:
+                raise subprocess.CalledProcessError(1, 'svn')
+            if not recursive:
+                return [(i, '1', 100) for i in self[url]]
+            paths = [(k + '/' + i)[len(url) + 1:] for k, v in self.items() for i in v if k.startswith(url + '/') or k == url]
+            return [(i, '1', 100) for i in sorted(paths)]
+
+    tree = svn_tree()
+    monkeypatch.setattr(svn, 'svn_ls', tree.ls)
+    return tree
+
 @fixture(scope='function', autouse=True)
-def cleanup(request, jenkins):
+def cleanup(request):
+    # Unit tests that do not use jenkins do not need a running instance.
+    if 'jenkins' not in request.fixturenames:
+        return
+    jenkins = request.getfixturevalue('jenkins')
+
     def finalize():
         jobs = (job for job in jenkins.jobs if job.name != 'master-job-svn')
         for job in jobs:
@@ -202,6 +234,7 @@ def test_make_trunk(jenkins, repo, config):
 
 #------------------------------------------------------------------------------
 def test_nested_svnls(repo_nested):
+    list_branches = lambda config: [name for name, rev in svn.list_branches(config)]
     config = {
         'repo': repo_nested.url,
         'branches': [],
@@ -210,12 +243,12 @@ def test_nested_svnls(repo_nested):
     }
 
     config['branches'] = [repo_nested.url + '/A/branches']
-    assert svn.list_branches(config) == [
+    assert list_branches(config) == [
         'A/branches/1', 'A/branches/2', 'A/branches/3'
     ]
 
     config['branches'] = [repo_nested.url + '/*/branches']
-    assert svn.list_branches(config) == [
+    assert list_branches(config) == [
         'A/branches/1', 'A/branches/2', 'A/branches/3',
         'B/branches/1', 'B/branches/2', 'B/branches/3',
         'C/branches/1', 'C/branches/2', 'C/branches/3',
@@ -223,7 +256,7 @@ def test_nested_svnls(repo_nested):
     ]
 
     config['branches'] = [repo_nested.url + '/*/*/branches/']
-    assert svn.list_branches(config) == [
+    assert list_branches(config) == [
         'sub1/A/branches/1', 'sub1/A/branches/2', 'sub1/A/branches/3',
         'sub1/B/branches/1', 'sub1/B/branches/2', 'sub1/B/branches/3',
         'sub1/C/branches/1', 'sub1/C/branches/2', 'sub1/C/branches/3',
@@ -233,3 +266,192 @@ def test_nested_svnls(repo_nested):
         'sub2/C/branches/1', 'sub2/C/branches/2', 'sub2/C/branches/3',
         'sub2/D/branches/1', 'sub2/D/branches/2', 'sub2/D/branches/3'
     ]
+
+
+#-----------------------------------------------------------------------------
+def test_wildcard_listing(svn_tree):
+    svn_tree.update({
+        'r': ['a', 'b', 'branches'],
+        'r/a': ['branches', 'tags'], 'r/a/branches': ['x'], 'r/a/tags': ['t'],
+        'r/b': ['branches'], 'r/b/branches': ['y'],
+        'r/branches': ['z'],
+    })
+
+    config = {'repo': 'r', 'branches': ['r/branches/', 'r/*/branches', 'r/*/tags'],
+              'scm-username': None, 'scm-password': None, 'state-file': None}
+    expected = [('branches/z', '1'), ('a/branches/x', '1'), ('b/branches/y', '1'), ('a/tags/t', '1')]
+
+    assert svn.list_branches(config) == expected
+    assert sorted(svn_tree.calls) == ['r', 'r/a/branches', 'r/a/tags', 'r/b/branches', 'r/b/tags',
+                                      'r/branches', 'r/branches/branches', 'r/branches/tags']
+
+    del svn_tree.calls[:]
+    config['list-recursive'] = True
+    assert svn.list_branches(config) == expected
+    assert sorted(svn_tree.calls) == ['r', 'r/branches']
+
+def test_wildcard_listing_recursive(svn_tree):
+    # Directories below and between the branches must not be mistaken for them.
+    svn_tree.update({
+        'r': ['p', 'q', 'trunk'],
+        'r/p': ['branches', 'docs'], 'r/p/branches': ['one', 'two'], 'r/p/branches/one': ['src'],
+        'r/p/docs': ['branches'], 'r/p/docs/branches': ['three'],
+        'r/q': ['branches'], 'r/q/branches': ['four'], 'r/q/branches/four': ['branches'],
+        'r/trunk': ['src'], 'r/trunk/src': ['a'],
+    })
+
+    config = {'repo': 'r', 'branches': ['r/*/branches', 'r/p/*/branches/', 'r/*/branches/*/src'],
+              'scm-username': None, 'scm-password': None, 'state-file': None}
+
+    levels = svn.list_branches(config)
+    config['list-recursive'] = True
+    assert svn.list_branches(config) == levels
+    assert levels == [('p/branches/one', '1'), ('p/branches/two', '1'), ('q/branches/four', '1'),
+                      ('p/docs/branches/three', '1')]
+
+def test_wildcard_listing_cache(svn_tree, monkeypatch):
+    svn_tree.update({'r': ['a', 'b'], 'r/a': ['branches'], 'r/a/branches': ['x'], 'r/b': ['branches'], 'r/b/branches': ['y']})
+    config = {'repo': 'r', 'branches': ['r/*/branches'],
+              'scm-username': None, 'scm-password': None, 'state-file': None}
+
+    # Directories whose last changed revision did not change are not listed again.
+    revisions = dict((url, '1') for url in svn_tree)
+    store = State(':memory:')
+    monkeypatch.setattr(svn, 'svn_info', lambda urls, *args: dict((i, revisions[i]) for i in urls if i in revisions))
+    monkeypatch.setattr(svn.main, 'state', store)
+
+    expected = [('a/branches/x', '1'), ('b/branches/y', '1')]
+    assert svn.list_branches(config) == expected
+    assert len(svn_tree.calls) == 3
+
+    del svn_tree.calls[:]
+    assert svn.list_branches(config) == expected
+    assert svn_tree.calls == []
+
+    svn_tree['r/b/branches'].append('w')
+    revisions['r/b/branches'] = '2'
+    assert svn.list_branches(config) == expected + [('b/branches/w', '1')]
+    assert svn_tree.calls == ['r/b/branches']
+
+def test_info_quoted_urls(monkeypatch):
+    xml = lxml.etree.fromstring(
+        '<info>'
+        '<entry><url>file:///r/branches/with%20space</url><commit revision="3"/></entry>'
+        '<entry><url>file:///r/branches/caf%C3%A9/</url><commit revision="4"/></entry>'
+        '</info>')
+    monkeypatch.setattr(svn, 'svn_xml_iter', lambda cmd, check=True: iter(xml))
+
+    urls = [u'file:///r/branches/with space', u'file:///r/branches/caf\xe9', u'file:///r/missing']
+    assert svn.svn_info(urls) == {urls[0]: '3', urls[1]: '4'}
+
+def test_info_chunked(monkeypatch):
+    chunks = []
+    def svn_xml_iter(cmd, check=True):
+        urls = [i for i in cmd if i.startswith('file://')]
+        chunks.append(urls)
+        xml = ''.join('<entry><url>%s</url><commit revision="1"/></entry>' % i for i in urls)
+        return iter(lxml.etree.fromstring('<info>%s</info>' % xml))
+
+    monkeypatch.setattr(svn, 'svn_xml_iter', svn_xml_iter)
+    monkeypatch.setattr(svn, 'info_chunk_size', 2)
+
+    urls = ['file:///r/branches/%d' % i for i in range(5)]
+    assert svn.svn_info(iter(urls)) == dict((i, '1') for i in urls)
+    assert chunks == [urls[0:2], urls[2:4], urls[4:]]
+
+def test_open_store(tmpdir, monkeypatch):
+    path = str(tmpdir.join('state.db'))
+    monkeypatch.setattr(svn.main, 'state', None)
+
+    with svn.open_store({'state-file': None}) as store:
+        assert store is None
+
+    # A state file that is not open already is opened and closed again.
+    with svn.open_store({'state-file': path}) as store:
+        store.set_meta('r', 'key', 'value')
+    with pytest.raises(sqlite3.ProgrammingError):
+        store.get_meta('r', 'key')
+
+    # The state of the run or batch is reused and left open.
+    state = State(path)
+    monkeypatch.setitem(svn.main.states, path, state)
+    with svn.open_store({'state-file': path}) as store:
+        assert store is state
+    assert state.get_meta('r', 'key') == 'value'
+    state.close()
+
+def test_bindings(monkeypatch):
+    tree = {'': ['branches'], 'branches': ['one', 'two'], 'branches/one': ['src'], 'branches/one/src': [], 'branches/two': []}
+    calls = []
+
+    class core:
+        SVN_AUTH_PARAM_NON_INTERACTIVE = 'non-interactive'
+        SVN_AUTH_PARAM_DEFAULT_USERNAME = 'username'
+        SVN_AUTH_PARAM_DEFAULT_PASSWORD = 'password'
+        SVN_DIRENT_KIND, SVN_DIRENT_CREATED_REV, SVN_DIRENT_TIME = 1, 2, 4
+        SVN_INVALID_REVNUM = -1
+        svn_node_dir = 2
+
+        class SubversionException(Exception):
+            apr_err = 160013
+
+        svn_auth_get_simple_provider = svn_auth_get_username_provider = staticmethod(lambda: 'provider')
+        svn_auth_get_ssl_server_trust_file_provider = staticmethod(lambda: 'provider')
+        svn_auth_get_ssl_server_trust_prompt_provider = staticmethod(lambda func: 'provider')
+        svn_auth_open = staticmethod(lambda providers: {})
+        svn_auth_set_parameter = staticmethod(lambda auth, key, value: auth.__setitem__(key, value))
+        svn_uri_canonicalize = staticmethod(lambda url: url.rstrip('/').encode('utf8'))
+
+    class dirent:
+        kind, created_rev, time = 2, 7, 1457006400 * 1000000
+
+    class ra:
+        class Callbacks:
+            auth_baton = None
+
+        class Session:
+            url = None
+
+        @staticmethod
+        def open2(url, callbacks, config):
+            calls.append(('open2', url, callbacks.auth_baton, config))
+            return ra.Session()
+
+        @staticmethod
+        def get_repos_root(session):
+            return b'file:///r'
+
+        @staticmethod
+        def reparent(session, url):
+            session.url = url
+
+        @staticmethod
+        def get_dir2(session, path, revision, fields):
+            path = '/'.join(i for i in (session.url[len('file:///r/'):], path) if i)
+            calls.append(('get_dir2', path, revision, fields))
+            if path not in tree:
+                raise core.SubversionException()
+            return dict((name.encode('utf8'), dirent) for name in tree[path]), 1, {}
+
+    monkeypatch.setattr(svn, 'svn_core', core)
+    monkeypatch.setattr(svn, 'svn_ra', ra)
+
+    config = {'scm-username': 'user', 'scm-password': 'secret'}
+    assert isinstance(svn.get_backend(config), svn.SvnCli)
+    config['list-bindings'] = True
+    backend = svn.get_backend(config)
+    assert isinstance(backend, svn.SvnBindings)
+
+    assert backend.ls('file:///r/branches/') == [('one', '7', 1457006400), ('two', '7', 1457006400)]
+    assert backend.ls('file:///r', recursive=True) == [
+        ('branches', '7', 1457006400), ('branches/one', '7', 1457006400),
+        ('branches/one/src', '7', 1457006400), ('branches/two', '7', 1457006400)]
+
+    # One session is opened and reused for all urls in the repository.
+    auth = {'non-interactive': '', 'username': 'user', 'password': 'secret'}
+    assert calls[0] == ('open2', 'file:///r/branches', auth, {})
+    assert [i for i in calls if i[0] == 'open2'] == [calls[0]]
+    assert calls[1] == ('get_dir2', 'branches', -1, 7)
+
+    with pytest.raises(subprocess.CalledProcessError):
+        backend.ls('file:///r/missing')
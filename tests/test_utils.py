@@ -1,25 +1,42 @@
 # -*- coding: utf-8; -*-
 
 import re
+import time
+import pytest
+import lxml.etree
 
-from jenkins_autojobs import main
+from collections import OrderedDict
+from jenkins_autojobs import main, job, utils, git
+from jenkins_autojobs.inventory import Inventory
+from jenkins_autojobs.state import State
+from conftest import StubView
 
 
-def test_filter_jobs():
-    class Job:
-        def __init__(self, name):
-            self.name = name
+#-----------------------------------------------------------------------------
+def get_raw_config(**kw):
+    config = {'jenkins': 'http://127.0.0.1:60888', 'repo': 'repo', 'template': 'tmpl',
+              'refs': ['refs/heads/(.*)']}
+    config.update(kw)
+    return config
 
-    class jenkins:
-        @staticmethod
-        def view_jobs(x):
-            return {
-                'v1': [Job('scratch-one'), Job('scratch-two')],
-                'v2': [Job('release-one'), Job('maintenance-three')]
-            }[x]
+def get_config(**kw):
+    return main.get_default_config(get_raw_config(**kw), main.parseopts([]))
+
+def connect(monkeypatch, jenkins, state=None, full=True):
+    '''Point main at a stub jenkins, as main.connect() would.'''
+    monkeypatch.setattr(main, 'jenkins', jenkins)
+    monkeypatch.setattr(main, 'inventory', Inventory(jenkins, full))
+    monkeypatch.setattr(main, 'state', state)
+
+#-----------------------------------------------------------------------------
+
+def test_filter_jobs(stub_jenkins):
+    jenkins = stub_jenkins
+    for name in ['feature-one', 'feature-two', 'release-one', 'release-two']:
+        jenkins.add_job(name)
+    jenkins.add_view('v1', 'scratch-one', 'scratch-two')
+    jenkins.add_view('v2', 'release-one', 'maintenance-three')
 
-    names = ['feature-one', 'feature-two', 'release-one', 'release-two']
-    jenkins.jobs = [Job(i) for i in names]
     filter_jobs = lambda **kw: {i.name for i in main.filter_jobs(jenkins, **kw)}
 
     #-------------------------------------------------------------------------
@@ -37,3 +54,463 @@ def test_filter_jobs():
 
     res = filter_jobs(by_views=['v1', 'v2'])
     assert res == {'scratch-one', 'scratch-two', 'release-one', 'maintenance-three'}
+
+
+def test_reconcile_order_and_failures(capsys):
+    def process(branch, branch_config):
+        print('processing %s' % branch)
+        if branch == 'three':
+            raise ValueError(branch)
+        return 'job-' + branch
+
+    configs = [(i, {}) for i in ('one', 'two', 'three', 'four')]
+    res = list(main.reconcile(process, configs, jobs=3))
+
+    assert [i[0] for i in res] == ['one', 'two', 'three', 'four']
+    assert [i[2] for i in res] == ['job-one', 'job-two', None, 'job-four']
+    assert 'ValueError: three' in res[2][3]
+
+    out = capsys.readouterr()[0].splitlines()
+    assert out == ['processing one', 'processing two', 'processing three', 'processing four']
+
+
+def test_parallel_map():
+    taken = []
+    def items():
+        for i in range(10):
+            taken.append(i)
+            if i == 7:
+                raise ValueError(i)
+            yield i
+
+    res = utils.parallel_map(lambda i: i * 2, items(), jobs=2)
+    assert next(res) == 0 and len(taken) == 4
+
+    # Errors of the iterable are raised to the caller.
+    with pytest.raises(ValueError):
+        list(res)
+    assert taken == list(range(8))
+
+
+def test_inventory(stub_jenkins):
+    jenkins = stub_jenkins
+    jenkins.add_job('one')
+    jenkins.add_job('two')
+    jenkins.add_view('All')
+    jenkins.add_view('Tests', 'one')
+    inventory = Inventory(jenkins)
+
+    assert inventory.job_exists('one') and not inventory.job_exists('three')
+    assert inventory.view_exists('All') and not inventory.view_exists('Other')
+
+    inventory.add_job('three')
+    inventory.remove_job('one')
+    assert inventory.jobs == {'two', 'three'}
+
+    assert not inventory.view_has_job('Tests', 'two')
+    inventory.view_add_job('Tests', 'two')
+    assert inventory.view_jobs('Tests') == {'one', 'two'}
+    inventory.remove_job('two')
+    assert inventory.view_jobs('Tests') == {'one'}
+    assert jenkins.requests() == ['GET api/json?tree=jobs[name],views[name]', 'GET view/Tests/config.xml']
+
+    # A partial inventory looks up jobs one at a time and remembers them.
+    del jenkins.server.requests[:]
+    inventory = Inventory(jenkins, full=False)
+    assert inventory.job_exists('one') and not inventory.job_exists('three')
+    assert inventory.job_exists('one') and not inventory.job_exists('three')
+    inventory.add_job('three')
+    assert inventory.job_exists('three')
+    assert jenkins.requests() == ['GET job/one/api/json', 'GET job/three/api/json']
+
+
+def test_get_managed_jobs(stub_jenkins):
+    jenkins = stub_jenkins
+    jenkins.add_job('managed', '<description>(created by jenkins-autojobs)</description>',
+                    '(created by jenkins-autojobs)')
+    jenkins.add_job('unmanaged', '<description></description>')
+    jenkins.add_job('forbidden', None)
+    jenkins.add_job('created', '<description>(created by jenkins-autojobs)</description>',
+                    '(created by jenkins-autojobs)')
+    jenkins.add_job('element', '<createdByJenkinsAutojobs></createdByJenkinsAutojobs>')
+
+    progress = main.utils.Counter()
+    res = main.get_managed_jobs({'created': {}}, jenkins, jobs=3, progress=progress)
+    assert [job.name for job, config in res] == ['managed', 'element']
+    assert progress.value == 4
+
+    # With the description tag-method, descriptions are listed in pages.
+    del jenkins.server.requests[:]
+    descriptions = main.get_job_descriptions(jenkins, page_size=2)
+    assert len(descriptions) == 5 and len(jenkins.requests()) == 3
+    assert jenkins.requests()[-1] == 'GET api/json?tree=jobs[name,description]{4,6}'
+
+    res = main.get_managed_jobs({'created': {}}, jenkins, tag_method='description',
+                                descriptions=descriptions)
+    assert [job.name for job, description in res] == ['managed']
+
+    # Without the listing, only the descriptions of the candidates are fetched.
+    del jenkins.server.requests[:]
+    only = lambda jenkins: [jenkins.job('managed'), jenkins.job('element')]
+    res = main.get_managed_jobs({}, jenkins, only, tag_method='description')
+    assert [job.name for job, description in res] == ['managed']
+    assert jenkins.requests() == ['GET job/managed/api/json?tree=description',
+                                  'GET job/element/api/json?tree=description']
+
+
+def test_state(tmpdir):
+    state = State(str(tmpdir.join('state.db')))
+    assert state.get_job('repo', 'refs/heads/one') is None
+
+    state.set_job('repo', 'refs/heads/one', 'one', 'abc')
+    state.set_job('repo', 'refs/heads/two', 'two', 'def')
+    state.set_job('other', 'refs/heads/one', 'other-one', 'ghi')
+    state.set_job('repo', 'refs/heads/one', 'one', 'jkl')
+    assert tuple(state.get_job('repo', 'refs/heads/one')) == ('one', 'jkl')
+
+    assert state.prune_jobs('repo', ['refs/heads/one']) == ['refs/heads/two']
+    assert state.get_job('repo', 'refs/heads/two') is None
+    assert state.get_job('other', 'refs/heads/one') is not None
+
+    assert state.get_refs('repo') == {}
+    state.set_refs('repo', [('refs/heads/one', 'abc'), ('refs/heads/two', 'def')])
+    state.set_refs('repo', [('refs/heads/one', 'ghi')])
+    assert state.get_refs('repo') == {'refs/heads/one': 'ghi'}
+
+    assert state.get_meta('repo', 'config-digest') is None
+    state.set_meta('repo', 'config-digest', 'abc')
+    assert state.get_meta('repo', 'config-digest') == 'abc'
+
+
+def test_update_view_jobs(stub_jenkins, monkeypatch):
+    jenkins = stub_jenkins
+    jenkins.add_view('list', 'one')
+    jenkins.views['other'] = '<hudson.model.MyView/>'
+
+    assert main.update_view_jobs(jenkins, 'list', ['one', 'two', 'three']) == []
+    assert jenkins.view_jobs('list') == [jenkins.job(i) for i in ('one', 'two', 'three')]
+    assert jenkins.requests('POST') == ['POST view/list/config.xml']
+
+    assert main.update_view_jobs(jenkins, 'other', ['one', 'two']) == ['one', 'two']
+    assert jenkins.requests('POST') == ['POST view/list/config.xml']
+
+    # Another client adds a job to the view after each of our reads.
+    class RacyView(StubView):
+        def read(self):
+            config = StubView.config.fget(self)
+            name = 'other-%d' % len(self.server.requests)
+            self.jenkins.views[self.name] = config.replace('</jobNames>', '<string>%s</string></jobNames>' % name)
+            return config
+        config = property(read, StubView.config.fset)
+
+    jenkins.add_view('racy', 'one')
+    monkeypatch.setattr(jenkins, 'view', lambda name: RacyView(jenkins, name))
+    assert main.update_view_jobs(jenkins, 'racy', ['one', 'two']) == ['two']
+    assert len(jenkins.requests('POST')) == 1
+
+    # The view is never written while it changes and the rest is added one at a time.
+    connect(monkeypatch, jenkins)
+    main.add_pending_view_jobs(get_config(), {'racy': ['one', 'two']})
+    assert jenkins.requests('POST')[1:] == ['POST view/racy/addJobToView?name=two']
+    others = [i for i in jenkins.view_jobs('racy') if i.name.startswith('other-')]
+    assert len(others) == len(jenkins.requests('GET view/racy/config.xml'))
+
+
+def test_template_render(stub_inventory):
+    xml = lxml.etree.fromstring('<project><scm><branch>master</branch></scm><cmd>run <b/>tail</cmd></project>')
+    template = job.Template('tmpl', xml)
+    digest = template.digest
+
+    def render(branch):
+        obj = job.Job(branch, branch, template, None, stub_inventory)
+        scm_el = template.xpath('scm')[0]
+        obj.set_text(template.xpath('//branch')[0], branch)
+        obj.set_or_create_text('//localBranch', scm_el, branch)
+        obj.tail[template.xpath('//b')[0]] = 'on ' + branch
+        obj.tag_config()
+        return template.render(obj.text, obj.tail, obj.elements).decode('utf8')
+
+    # Missing elements are added to the rendered job, not to the template.
+    branches = ['branch-%d' % i for i in range(20)]
+    for branch, res in zip(branches, utils.parallel_map(render, branches, jobs=4)):
+        assert '<scm><branch>%s</branch><localBranch>%s</localBranch></scm>' % (branch, branch) in res
+        assert '<cmd>run <b></b>on %s</cmd>' % branch in res
+        assert '<description>\n(created by jenkins-autojobs)</description>' in res
+
+    assert xml.find('scm/localBranch') is None and xml.find('description') is None
+    assert xml.find('cmd/b').tail == 'tail'
+    assert template.digest == digest == job.hashlib.sha1(job.Job.canonicalize(xml)).hexdigest()
+
+
+def test_template_substitute(stub_inventory):
+    xml = lxml.etree.fromstring(
+        '<project><description>@@NAME@@</description><disabled>false</disabled>'
+        '<cmd>run @@NAME@@ <b/>then @@NAME@@ on @@NAME@@-@@REF@@</cmd></project>')
+    template = job.Template('tmpl', xml)
+
+    # Values of keys that are not in the template are not formatted.
+    items = [('@@NAME@@', '{job_name}'), ('@@NAME@@-@@REF@@', '{0}/{ref}'), ('@@X@@', '{missing}')]
+    obj = job.Job('job-one', 'one', template, None, stub_inventory)
+    obj.substitute(items, {'job_name': 'job-one', 'ref': 'r'}, ('one',), {})
+    obj.set_state(False)
+    obj.tag_config(method='element')
+
+    res = template.render(obj.text, obj.tail, obj.elements).decode('utf8')
+    assert '<description>job-one</description>' in res
+    assert '<disabled>true</disabled>' in res
+    assert '<cmd>run job-one <b></b>then job-one on one/r</cmd>' in res
+    assert '<createdByJenkinsAutojobs><ref>one</ref></createdByJenkinsAutojobs>' in res
+
+    # The template itself is left unchanged.
+    assert lxml.etree.tostring(xml).decode('utf8').count('@@NAME@@') == 4
+    assert xml.find('createdByJenkinsAutojobs') is None
+
+
+def test_daemon_backoff(monkeypatch, stub_inventory):
+    runs, delays = [], []
+    ready = [False, KeyError('refs'), True, True]
+
+    def run(*args):
+        runs.append(args)
+        if len(runs) == 1:
+            raise RuntimeError('not a git template')
+        if len(runs) == 3:
+            raise KeyboardInterrupt
+        return 0
+
+    def prepare(config, templates):
+        res = ready.pop(0)
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    class opts:
+        yamlconfig = None
+
+    monkeypatch.setattr(main, 'run', run)
+    monkeypatch.setattr(main, 'inventory', stub_inventory)
+    monkeypatch.setattr(main, 'prepare', prepare)
+    monkeypatch.setattr(main, 'get_poll_delay', lambda interval, max_interval, failures: failures)
+    monkeypatch.setattr(main.time, 'sleep', delays.append)
+
+    # Errors in a poll and polls without templates back off, but do not stop the daemon.
+    main.daemon({'poll-interval': 1, 'poll-max-interval': 1}, opts, None, None, {})
+    assert len(runs) == 3 and delays == [1, 2, 3, 0]
+
+
+def test_classify_refs():
+    refs = OrderedDict([
+        (re.compile('refs/heads/feature-(.*)'), {'n': 1}),
+        (re.compile('refs/heads/.*'), {'n': 2}),
+    ])
+    ignore = [re.compile('refs/heads/feature-wip'), re.compile('.*/tmp')]
+    pairs = [(i, None) for i in ignore] + list(refs.items())
+    config = {'refs': refs, 'matcher': utils.RefMatcher(pairs)}
+
+    branches = ['refs/heads/feature-one', 'refs/heads/feature-wip-two', 'refs/heads/master',
+                'refs/tags/v1', 'refs/heads/tmp']
+    ignored, configs = main.classify_refs(config, branches)
+
+    assert ignored == ['refs/heads/feature-wip-two', 'refs/heads/tmp']
+    assert [(i, c['n']) for i, c in configs] == [('refs/heads/feature-one', 1), ('refs/heads/master', 2)]
+    assert configs[0][1]['re'].pattern == 'refs/heads/feature-(.*)'
+
+
+def test_get_vanished_jobs(monkeypatch):
+    state = State(':memory:')
+    monkeypatch.setattr(main, 'state', state)
+
+    refs = OrderedDict([(re.compile('refs/heads/(.*)'), {})])
+    config = {'repo': 'repo', 'refs': refs, 'matcher': utils.RefMatcher(list(refs.items()))}
+    get_job_name = lambda ref, config, ref_config: ref_config['re'].match(ref).group(1)
+
+    assert main.get_vanished_jobs(config, {}, [], get_job_name) is None
+
+    state.set_job('repo', 'refs/heads/one', 'job-one', 'abc')
+    state.set_job('repo', 'refs/heads/two', 'job-two', 'abc')
+    state.set_refs('repo', [('refs/heads/one', 'a'), ('refs/heads/two', 'b'), ('refs/heads/three', 'c')])
+    state.set_meta('repo', 'refs-time', '0')
+
+    # Recorded job names are preferred over computed ones.
+    res = main.get_vanished_jobs(config, {'refs/heads/one': 'a'}, ['refs/heads/one'], get_job_name)
+    assert res == ['job-two', 'three']
+
+
+def test_targeted_cleanup(stub_jenkins, monkeypatch):
+    jenkins = stub_jenkins
+    for i in range(50):
+        jenkins.add_job('job-%d' % i, description='(created by jenkins-autojobs)')
+
+    state = State(':memory:')
+    state.set_meta('repo', 'cleanup-full-time', str(time.time()))
+    connect(monkeypatch, jenkins, state)
+    config = get_config(cleanup=True)
+    del jenkins.server.requests[:]
+
+    # Nothing is fetched if no ref vanished.
+    assert main.run_cleanup(config, {}, []) == []
+    assert jenkins.requests() == []
+
+    # Only the jobs of the refs that vanished are looked at.
+    removed = main.run_cleanup(config, {}, ['job-1', 'job-2'])
+    assert sorted(job.name for job in removed) == ['job-1', 'job-2']
+    assert sorted(jenkins.requests()) == [
+        'GET job/job-1/api/json?tree=description', 'GET job/job-2/api/json?tree=description',
+        'POST job/job-1/doDelete', 'POST job/job-2/doDelete',
+    ]
+
+    # The same goes for refs that were deleted with --ref or --refs-from.
+    del jenkins.server.requests[:]
+    state.set_job('repo', 'refs/heads/three', 'job-3', 'abc')
+    main.remove_ref_jobs(config, [('refs/heads/three', {})], None)
+    assert jenkins.requests() == ['GET job/job-3/api/json?tree=description', 'POST job/job-3/doDelete']
+    assert len(jenkins.configs) == 47 and state.get_job('repo', 'refs/heads/three') is None
+
+
+def test_run_batch(stub_jenkins, monkeypatch, capsys):
+    jenkins = stub_jenkins
+    jenkins.add_job('tmpl', '<project><description/></project>')
+    for name in ('stale-a', 'stale-b'):
+        jenkins.add_job(name, description='(created by jenkins-autojobs)')
+    jenkins.add_job('unrelated')
+
+    refs = {'a': ['refs/heads/one', 'refs/heads/two'], 'b': ['refs/heads/three']}
+    list_branches = lambda config: [(ref, 'abc') for ref in refs[config['repo']]]
+
+    def create_job(ref, template, config, ref_config):
+        name = '%s-%s' % (config['repo'], ref.split('/')[-1])
+        if not main.inventory.job_exists(name):
+            jenkins.job_create(name, '<project/>')
+            main.inventory.add_job(name)
+        return name
+
+    monkeypatch.setattr(main, 'connect', lambda config, full=True: connect(monkeypatch, jenkins))
+    configs = [get_raw_config(repo='a', cleanup=True), get_raw_config(repo='b', cleanup=True)]
+    assert main.run_batch(configs, main.parseopts([]), create_job, list_branches) == 0
+
+    # Jobs and their descriptions are listed once for all configs.
+    assert len(jenkins.requests(r'tree=jobs\[name\]$')) == 1
+    assert len(jenkins.requests(r'tree=jobs\[name,description\]')) == 1
+    assert len(jenkins.requests('GET job/tmpl/config.xml')) == 1
+    assert jenkins.requests('doDelete') == ['POST job/stale-a/doDelete', 'POST job/stale-b/doDelete']
+    assert list(jenkins.configs) == ['tmpl', 'unrelated', 'a-one', 'a-two', 'b-three']
+
+    out = capsys.readouterr()[0]
+    assert ' - a (a): ok - 2 jobs, 0 failed, 2 removed' in out
+    assert ' - b (b): ok - 1 jobs, 0 failed, 0 removed' in out
+
+
+def test_process_branch_fingerprint(stub_jenkins, monkeypatch):
+    jenkins = stub_jenkins
+    with open('master-job-git-config.xml') as fh:
+        jenkins.add_job('master-job-git', fh.read())
+
+    state = State(':memory:')
+    connect(monkeypatch, jenkins, state)
+    config = get_config(template='master-job-git')
+    templates = {}
+    assert main.prepare(config, templates)
+
+    ignored, configs = main.classify_refs(config, ['refs/heads/one', 'refs/heads/two'])
+    process = lambda configs: [main.process_branch(git.create_job, templates, config, *i) for i in configs]
+
+    assert process(configs) == ['one', 'two']
+    assert jenkins.requests('POST') == ['POST createItem?name=one', 'POST createItem?name=two']
+
+    # Unchanged refs are skipped without a request.
+    del jenkins.server.requests[:]
+    assert process(configs) == ['one', 'two']
+    assert jenkins.requests() == []
+
+    # A change to the config of a ref re-renders its job.
+    changed = [(branch, dict(branch_config, substitute={'@@JOB_NAME@@': branch}))
+               for branch, branch_config in configs[:1]]
+    process(changed + configs[1:])
+    assert jenkins.requests() == ['GET job/one/config.xml', 'POST job/one/config.xml']
+
+    # A change to the template re-renders all jobs.
+    del jenkins.server.requests[:]
+    jenkins.configs['master-job-git'] = jenkins.configs['master-job-git'].replace(
+        '<keepDependencies>false', '<keepDependencies>true')
+    assert main.prepare(config, templates)
+    process(changed + configs[1:])
+    assert jenkins.requests('job/(one|two)/') == [
+        'GET job/one/config.xml', 'POST job/one/config.xml',
+        'GET job/two/config.xml', 'POST job/two/config.xml',
+    ]
+
+
+def test_split_unchanged(stub_jenkins, monkeypatch, capsys):
+    jenkins = stub_jenkins
+    for name in ('one', 'two', 'gone'):
+        jenkins.add_job(name)
+
+    state = State(':memory:')
+    connect(monkeypatch, jenkins, state)
+    config = get_config()
+
+    refs = OrderedDict([('refs/heads/one', 'a'), ('refs/heads/two', 'b2'),
+                        ('refs/heads/three', 'c'), ('refs/heads/new', 'd')])
+    ignored, configs = main.classify_refs(config, list(refs))
+    split = lambda digest: [[i[0] for i in res] for res in main.split_unchanged(config, refs, configs, digest)]
+
+    # Everything is processed without a previous run.
+    assert split('abc') == [list(refs), []]
+
+    state.set_refs('repo', [('refs/heads/one', 'a'), ('refs/heads/two', 'b'),
+                            ('refs/heads/three', 'c'), ('refs/heads/gone', 'e')])
+    for ref in ('one', 'two', 'three', 'gone'):
+        state.set_job('repo', 'refs/heads/' + ref, ref, 'fp')
+    state.set_meta('repo', 'config-digest', 'abc')
+
+    # Refs whose head changed keep their job, like unchanged refs. Refs that
+    # are not in the state or whose job is gone are processed.
+    process, unchanged = split('abc')
+    assert process == ['refs/heads/three', 'refs/heads/new']
+    assert unchanged == ['refs/heads/one', 'refs/heads/two']
+    assert 'incremental: 2 new, 1 removed and 2 unchanged refs' in capsys.readouterr()[0]
+
+    # Everything is processed if the config or the templates changed.
+    assert split('def') == [list(refs), []]
+
+
+def test_run_refs(stub_jenkins, monkeypatch):
+    jenkins = stub_jenkins
+    with open('master-job-git-config.xml') as fh:
+        jenkins.add_job('master-job-git', fh.read())
+
+    connect(monkeypatch, jenkins, full=False)
+    config = get_config(template='master-job-git', cleanup=True)
+    templates = {}
+    assert main.prepare(config, templates)
+
+    # Twenty created refs, then a chunk with a deleted ref, a ref that is
+    # created and deleted and a ref that is given twice.
+    zero, sha = '0' * 40, 'a' * 40
+    lines = ['%s %s refs/heads/job-%d\n' % (zero, sha, i) for i in range(20)]
+    lines += ['%s %s refs/heads/job-0' % (sha, zero),
+              '%s %s refs/heads/job-20' % (zero, sha), '%s %s refs/heads/job-20' % (sha, zero),
+              'refs/heads/job-21', 'refs/heads/job-21']
+
+    consumed = []
+    def feed():
+        for line in lines:
+            consumed.append(line)
+            yield line
+
+    created = []
+    def create_job(ref, template, config, ref_config):
+        created.append((ref, len(consumed)))
+        return git.create_job(ref, template, config, ref_config)
+
+    status = main.run_refs(config, create_job, templates, utils.read_refs(feed()), git.get_job_name)
+    assert status == 0
+
+    # The refs are read in chunks of 16 and the last line for a ref wins.
+    names = ['job-%d' % i for i in range(20)] + ['job-21']
+    assert [ref.split('/')[-1] for ref, n in created] == names
+    assert [n for ref, n in created] == [16] * 16 + [25] * 5
+
+    assert list(jenkins.configs) == ['master-job-git'] + names[1:]
+    assert jenkins.requests('doDelete') == ['POST job/job-0/doDelete']
+    assert jenkins.requests('tree=jobs') == []
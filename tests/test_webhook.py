@@ -0,0 +1,80 @@
+# -*- coding: utf-8; -*-
+
+import json
+import time
+import threading
+
+from pytest import fixture
+from jenkins_autojobs import webhook
+
+try:
+    from urllib2 import Request, urlopen, HTTPError
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+
+
+#-----------------------------------------------------------------------------
+@fixture
+def receiver(request):
+    config = {'repo': 'repo', 'webhook-secret': None}
+    receiver = webhook.Receiver(('127.0.0.1', 0), config, {}, None, None)
+
+    thread = threading.Thread(target=receiver.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(receiver.stop)
+    return receiver
+
+def post(receiver, event, headers={}):
+    url = 'http://%s:%s/' % receiver.server.server_address[:2]
+    req = Request(url, json.dumps(event).encode('utf8'), headers)
+    try:
+        return urlopen(req).getcode()
+    except HTTPError as error:
+        return error.code
+
+
+#-----------------------------------------------------------------------------
+def test_event_queue():
+    queue = webhook.EventQueue()
+    queue.put('repo', 'refs/heads/one', False)
+    queue.put('repo', 'refs/heads/two', False)
+    queue.put('repo', 'refs/heads/one', True)
+
+    assert queue.get_stats()['queue-depth'] == 2
+    assert queue.get_all(delay=0) == [(('repo', 'refs/heads/one'), True), (('repo', 'refs/heads/two'), False)]
+
+    stats = queue.get_stats()
+    assert (stats['received'], stats['coalesced'], stats['queue-depth']) == (3, 1, 0)
+
+def test_event_queue_delay():
+    queue = webhook.EventQueue()
+
+    def push():
+        for ref in 'one', 'two', 'one':
+            time.sleep(0.05)
+            queue.put('repo', 'refs/heads/' + ref, False)
+
+    thread = threading.Thread(target=push)
+    thread.start()
+
+    # Events that arrive within the delay are returned together.
+    start = time.time()
+    events = queue.get_all(delay=0.5)
+    thread.join()
+
+    assert [ref for (repo, ref), deleted in events] == ['refs/heads/one', 'refs/heads/two']
+    assert time.time() - start >= 0.5
+    assert queue.get_stats()['coalesced'] == 1
+
+def test_secret(receiver):
+    event = {'repo': 'repo', 'ref': 'refs/heads/one'}
+    assert post(receiver, event) == 202
+    assert post(receiver, {'repo': 'repo'}) == 400
+
+    receiver.config['webhook-secret'] = 'abc'
+    assert post(receiver, event) == 403
+    assert post(receiver, event, {'X-Autojobs-Secret': 'abd'}) == 403
+    assert post(receiver, event, {'X-Autojobs-Secret': 'abc'}) == 202
+    assert len(receiver.queue) == 1